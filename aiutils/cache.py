@@ -4,19 +4,24 @@
 @file: cache.py
 缓存功能
 """
-import six
 import copy
+import datetime
 import inspect
-import json
 import os
 import sys
+import tempfile
 import time
 import threading
+import uuid
 import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from functools import update_wrapper, wraps
 from logbook import Logger
 from collections import OrderedDict, namedtuple
 import hashlib
+import heapq
+import itertools
 from importlib import import_module
 
 try:
@@ -24,6 +29,9 @@ try:
 except ImportError:
     import pickle
 
+from aiutils.cache_index import _BLOB_GRACE_SECOND, CacheIndex
+from aiutils.cache_stats import AIUTILS_CACHE_STATS
+
 # 参考写法 jqdatasdk.utils ---------------------------------------------------------------------------
 for _modname in ("functools", "fastcache", "functools32"):
     try:
@@ -47,83 +55,491 @@ else:
 
         return wrapper
 
-Serialized = namedtuple('Serialized', 'json')
 
+def _freeze_arg(obj):
+    """
+    参数转为可hash的结构，只用于计算缓存key
+    * list/tuple -> tuple，dict -> 排序后的(key, value)元组，set -> frozenset；带上原类型，避免list与tuple混淆
+    * numpy标量转为python标量；ndarray DataFrame Series取摘要(参考_fingerprint)
+    * datetime等可hash的对象保持不变
+    """
+    t = type(obj)
+    if t in _PRIMITIVE_TYPES:
+        return obj
+    if t in (list, tuple):
+        return t, tuple(_freeze_arg(x) for x in obj)
+    if t is dict:
+        items = [(_freeze_arg(k), _freeze_arg(v)) for k, v in obj.items()]
+        try:
+            items.sort()
+        except TypeError:  # key类型混合时无法直接比较
+            items.sort(key=repr)
+        return t, tuple(items)
+    if t in (set, frozenset):
+        return t, frozenset(_freeze_arg(x) for x in obj)
+    module = t.__module__
+    if module == 'numpy' and hasattr(obj, 'dtype') and hasattr(obj, 'shape'):
+        if obj.shape == ():  # numpy标量
+            return obj.item()
+        return t, _fingerprint(obj)  # 摘要，缓存的key不保留数组的副本
+    if module.startswith('pandas') and t.__name__ in ('DataFrame', 'Series'):
+        return _fingerprint(obj)
+    hash(obj)  # 其它不可hash的对象，在此抛出TypeError
+    return obj
+
+
+class _HashableArg(object):
+    """ 不可hash的参数：按冻结后的结构计算hash及比较，调用原函数时传入原对象 """
+    __slots__ = ('obj', 'frozen', '_hash')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.frozen = _freeze_arg(obj)
+        self._hash = hash(self.frozen)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, _HashableArg) and self.frozen == other.frozen
+
+
+def _wrap_arg(arg):
+    """ 可hash的参数原样返回，否则包装为_HashableArg """
+    if type(arg) in _PRIMITIVE_TYPES:
+        return arg
+    try:
+        hash(arg)
+    except TypeError:
+        return _HashableArg(arg)
+    return arg
+
+
+def _unwrap_arg(arg):
+    if isinstance(arg, _HashableArg):
+        obj, arg.obj = arg.obj, None  # 缓存的key只保留冻结结构，不再持有原对象
+        return obj
+    return arg
+
+
+class FrozenDict(dict):
+    """ 只读的dict：hashable_lru(frozen=True)的结果中，dict转为此类型；copy/deepcopy得到普通dict """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError(f"'{type(self).__name__}' object is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {copy.deepcopy(k, memo): copy.deepcopy(v, memo) for k, v in self.items()}
+
+
+class FrozenList(tuple):
+    """ 只读的list：hashable_lru(frozen=True)的结果中，list转为此类型；copy/deepcopy得到普通list """
+
+    def __reduce__(self):
+        return FrozenList, (tuple(self),)
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(x, memo) for x in self]
 
-def hashable_lru(maxsize=128):
-    """ 缓存装饰器：支持原函数参数中含有不可hash的情况；maxsize: 最大可缓存的结果数量 """
+
+class FrozenSet(frozenset):
+    """ 只读的set：hashable_lru(frozen=True)的结果中，set转为此类型；copy/deepcopy得到普通set """
+
+    def __reduce__(self):
+        return FrozenSet, (frozenset(self),)
+
+    def __copy__(self):
+        return set(self)
+
+    def __deepcopy__(self, memo):
+        return {copy.deepcopy(x, memo) for x in self}
+
+
+def _readonly_view(arr):
+    """ ndarray的只读视图，不修改原数组 """
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+
+def _freeze_result(obj):
+    """
+    结果转为只读，直接返回给调用方而不需要复制；原函数返回的对象本身不做修改(可能是模块级的共享对象)
+    * ndarray：只读的视图
+    * DataFrame/Series：浅复制，各个block替换为只读的视图
+    * list -> FrozenList，dict -> FrozenDict，set -> FrozenSet，tuple保持tuple，并递归处理其中的元素
+    """
+    t = type(obj)
+    if t in _PRIMITIVE_TYPES:
+        return obj
+    if t is list:
+        return FrozenList(_freeze_result(x) for x in obj)
+    if t is tuple:
+        return tuple(_freeze_result(x) for x in obj)
+    if t is dict:
+        return FrozenDict((k, _freeze_result(v)) for k, v in obj.items())
+    if t is set:
+        return FrozenSet(obj)
+    if hasattr(obj, 'flags') and hasattr(obj, 'dtype'):  # numpy.ndarray
+        return _readonly_view(obj)
+    if t.__module__.startswith('pandas') and hasattr(obj, '_mgr'):
+        obj = obj.copy(deep=False)
+        for blk in obj._mgr.blocks:
+            if hasattr(blk.values, 'flags'):  # ExtensionArray没有flags，不做处理
+                blk.values = _readonly_view(blk.values)
+    return obj
+
+
+def _contains_pandas(obj) -> bool:
+    """ _freeze_result的结果中是否含有DataFrame/Series """
+    t = type(obj)
+    if t in (FrozenList, tuple):
+        return any(_contains_pandas(x) for x in obj)
+    if t is FrozenDict:
+        return any(_contains_pandas(x) for x in obj.values())
+    return t.__module__.startswith('pandas') and hasattr(obj, '_mgr')
+
+
+def _result_view(obj):
+    """
+    命中时返回给调用方的对象：DataFrame/Series每次返回新的浅复制，共用只读的block；
+    调用方修改(copy-on-write时不报错)或增加列只影响该浅复制，不影响缓存的结果
+    """
+    t = type(obj)
+    if t is FrozenList:
+        return FrozenList(_result_view(x) for x in obj)
+    if t is tuple:
+        return tuple(_result_view(x) for x in obj)
+    if t is FrozenDict:
+        return FrozenDict((k, _result_view(v)) for k, v in obj.items())
+    if t.__module__.startswith('pandas') and hasattr(obj, '_mgr'):
+        return obj.copy(deep=False)
+    return obj
+
+
+def hashable_lru(maxsize=128, frozen=False):
+    """
+    缓存装饰器：支持原函数参数中含有不可hash的情况；maxsize: 最大可缓存的结果数量
+    * 不可hash的参数(list dict set ndarray等)按_freeze_arg冻结后计算key，调用原函数时传入原对象
+    * frozen=False：每次返回结果的deepcopy
+    * frozen=True：结果缓存时转为只读(参考_freeze_result)，命中时不再复制；DataFrame/Series每次返回新的浅复制(参考_result_view)
+      需要修改结果时，调用 func.cache_copy(*args, **kwargs) 得到可修改的副本(FrozenList FrozenDict FrozenSet还原为list dict set)
+    """
 
     def hashable_cache_internal(func):
         cache = lru_cache(maxsize=maxsize)
+        stats = AIUTILS_CACHE_STATS.get(_make_msg(func), 'hashable_lru')
+        local = threading.local()  # 记录本次调用是否未命中
 
-        def deserialize(value):
-            if isinstance(value, Serialized):
-                return json.loads(value.json)
-            else:
-                return value
+        def func_with_hashable_params(*args, **kwargs):
+            local.missed = True
+            _args = tuple([_unwrap_arg(arg) for arg in args])
+            _kwargs = {k: _unwrap_arg(v) for k, v in kwargs.items()}
+            t0 = time.perf_counter()
+            result = func(*_args, **_kwargs)
+            stats.computed(time.perf_counter() - t0)
+            if frozen:
+                result = _freeze_result(result)
+                return result, _contains_pandas(result)
+            return result
 
-        def func_with_serialized_params(*args, **kwargs):
-            _args = tuple([deserialize(arg) for arg in args])
-            _kwargs = {k: deserialize(v) for k, v in six.viewitems(kwargs)}
-            return func(*_args, **_kwargs)
+        cached_func = cache(func_with_hashable_params)
 
-        cached_func = cache(func_with_serialized_params)
+        def _cached(*args, **kwargs):
+            local.missed = False
+            t0 = time.perf_counter()
+            _args = tuple([_wrap_arg(arg) for arg in args])
+            _kwargs = {k: _wrap_arg(v) for k, v in kwargs.items()}
+            result = cached_func(*_args, **_kwargs)
+            if local.missed:
+                stats.miss()
+                currsize = cached_func.cache_info().currsize
+                evicted = int(maxsize is not None and currsize == stats.entries == maxsize)
+                stats.change(entries=currsize - stats.entries, evictions=evicted)
+            else:
+                stats.hit(time.perf_counter() - t0)
+            if frozen:
+                result, views = result
+                if views:
+                    result = _result_view(result)
+            return result
 
         @wraps(func)
         def hashable_cached_func(*args, **kwargs):
-            _args = tuple([
-                Serialized(json.dumps(arg, sort_keys=True))
-                if type(arg) in (list, dict) else arg
-                for arg in args
-            ])
-            _kwargs = {
-                k: Serialized(json.dumps(v, sort_keys=True))
-                if type(v) in (list, dict) else v
-                for k, v in kwargs.items()
-            }
-            return copy.deepcopy(cached_func(*_args, **_kwargs))
+            if frozen:
+                return _cached(*args, **kwargs)
+            return copy.deepcopy(_cached(*args, **kwargs))
+
+        def cache_clear():
+            cached_func.cache_clear()
+            stats.set_size(0)
 
         hashable_cached_func.cache_info = cached_func.cache_info
-        hashable_cached_func.cache_clear = cached_func.cache_clear
+        hashable_cached_func.cache_clear = cache_clear
+        hashable_cached_func.cache_copy = lambda *args, **kwargs: copy.deepcopy(_cached(*args, **kwargs))
         return hashable_cached_func
 
     return hashable_cache_internal
 
 
 # ---------------------------------------------------------------------------------------
-def ttl_cache(ttl):
-    """ 缓存装饰器：可设定缓存秒数 """
+class _BackgroundRefresher(object):
+    """
+    后台刷新(stale-while-revalidate)：有界线程池执行
+    * 同一key同时只刷新一次
+    * 排队的刷新超过max_pending时放弃本次刷新，调用方继续使用旧结果
+    """
+
+    def __init__(self, max_workers=4, max_pending=256):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key, func) -> bool:
+        """ func为无参数的可调用对象，需自行处理异常；返回是否提交 """
+        with self._lock:
+            if key in self._pending or len(self._pending) >= self.max_pending:
+                return False
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='CacheRefresh')
+
+        def run():
+            try:
+                func()
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        self._executor.submit(run)
+        return True
+
+
+_REFRESHER = _BackgroundRefresher()
+
+# ---------------------------------------------------------------------------------------
+def _tag_key(tag) -> str:
+    """ 标签：字符串，或 (库名, 表名) 等元组，元组以'.'连接 """
+    if isinstance(tag, (tuple, list)):
+        return '.'.join(str(x) for x in tag)
+    return str(tag)
+
+
+def _resolve_tags(tags, args, kwargs) -> tuple:
+    """
+    :param tags: 标签列表；或可调用对象，以被装饰函数的参数调用，返回标签列表；单个字符串或元组视为一个标签
+    """
+    if tags is None:
+        return ()
+    if callable(tags):
+        tags = tags(*args, **kwargs)
+    if tags is None:
+        return ()
+    if isinstance(tags, (str, tuple)):
+        tags = [tags]
+    return tuple(_tag_key(x) for x in tags)
+
+
+def _tag_file(cache_dir, tag) -> str:
+    """ PickleCache的标签文件：以'.'开头，不计入目录大小预算，也不会被清理 """
+    return os.path.join(cache_dir, '.tag_' + hashlib.blake2b(tag.encode(), digest_size=8).hexdigest())
+
+
+class _TagVersions(object):
+    """
+    标签版本：invalidate(tag)时版本加一
+    * 写入缓存时记录依赖标签的版本，读取时版本不一致即视为失效
+    * 版本只在本进程有效；PickleCache另外比较缓存文件与cache_dir中标签文件的修改时间，在进程之间失效
+    * 标签文件写入 dirs 中的目录：本进程使用标签的PickleCache目录、register_tag_dirs登记的目录、环境变量AIUTILS_TAG_DIRS
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.dirs = {x for x in os.environ.get('AIUTILS_TAG_DIRS', '').split(os.pathsep) if x}
+
+    def stamp(self, tags) -> tuple:
+        return tuple(self._versions.get(x, 0) for x in tags)
+
+    def bump(self, tags, cache_dirs=()):
+        with self._lock:
+            for x in tags:
+                self._versions[x] = self._versions.get(x, 0) + 1
+            dirs = self.dirs.union(cache_dirs)
+        now = time.time()
+        for cache_dir in dirs:
+            for x in tags:
+                tag_file = _tag_file(cache_dir, x)
+                try:
+                    with open(tag_file, 'a'):
+                        pass
+                    os.utime(tag_file, (now, now))
+                except OSError as e:
+                    warnings.warn(f'更新标签文件失败[{tag_file}] {type(e)}:{e}', RuntimeWarning)
+
+
+_TAGS = _TagVersions()
+
+
+def register_tag_dirs(*cache_dirs):
+    """
+    登记PickleCache的cache_dir，invalidate时在其中写入标签文件
+    * 读取方在其它进程时需要登记：例如只执行df_insert(bump_version=True)的入库进程，没有导入使用标签的被装饰函数
+    * 也可通过环境变量AIUTILS_TAG_DIRS设置，多个目录以os.pathsep分隔
+    """
+    with _TAGS._lock:
+        _TAGS.dirs.update(cache_dirs)
+
+
+def invalidate(*tags, cache_dirs=()):
+    """
+    使依赖这些标签的缓存结果失效：MemoryCache PickleCache ttl_cache 中以tags参数声明了该标签的结果
+    * 标签为字符串，或 (库名, 表名) 等元组
+    * 其它进程的PickleCache：只有标签文件所在的cache_dir有效，参考 register_tag_dirs；cache_dirs为本次额外写入的目录
+    """
+    _TAGS.bump([_tag_key(x) for x in tags], cache_dirs)
+
+
+_CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def ttl_cache(ttl, maxsize=128, refresh=None, tags=None):
+    """
+    缓存装饰器：可设定缓存秒数
+    * maxsize：最大缓存数量，超出时淘汰最久未使用的；为None时不限制数量
+    * 过期结果用最小堆记录，每次写入时清理，复杂度 O(log n)
+    * 线程安全；提供 cache_info() cache_clear()，以及按参数失效的 cache_invalidate(*args, **kwargs)
+    * refresh：软过期秒数(小于ttl)；超过refresh未超过ttl时返回旧结果，同时后台重新执行；超过ttl时同步执行
+    * tags：依赖的标签，参考 _resolve_tags；invalidate(tag)后依赖该标签的结果失效
+    """
     if not isinstance(ttl, int) or not ttl > 0:
         raise TypeError("Expected ttl to be a positive integer")
+    if refresh is not None and not 0 < refresh < ttl:
+        raise ValueError("Expected refresh to be between 0 and ttl")
+    if maxsize is not None and (not isinstance(maxsize, int) or not maxsize > 0):
+        raise TypeError("Expected maxsize to be a positive integer or None")
 
     def decorating_function(user_function):
-        wrapper = _ttl_cache_wrapper(user_function, ttl)
+        wrapper = _ttl_cache_wrapper(user_function, ttl, maxsize,
+                                     AIUTILS_CACHE_STATS.get(_make_msg(user_function), 'ttl_cache'), refresh, tags)
         return update_wrapper(wrapper, user_function)
 
     return decorating_function
 
 
-def _ttl_cache_wrapper(user_function, ttl):
-    sentinel = object()
-    cache = {}
-    cache_get = cache.get  # bound method to lookup a key or return None
+def _ttl_make_key(args, kwargs):
+    if kwargs:
+        return args + (repr(sorted(kwargs.items())),)
+    return args
 
-    def wrapper(*args, **kwargs):
-        if kwargs:
-            key = args + (repr(sorted(kwargs.items())),)
+
+def _ttl_cache_wrapper(user_function, ttl, maxsize, func_stats, refresh=None, tags=None):
+    cache = OrderedDict()  # key: (过期时间, 结果, 序号, 标签版本)；顺序即LRU顺序
+    expire_heap = []  # (过期时间, 序号, key)；序号与cache中不一致的为已覆盖的旧记录
+    counter = itertools.count()
+    lock = threading.RLock()
+    stats = [0, 0]  # hits, misses
+
+    def _purge(now) -> int:
+        purged = 0
+        while expire_heap and expire_heap[0][0] <= now:
+            _, seq, key = heapq.heappop(expire_heap)
+            entry = cache.get(key)
+            if entry is not None and entry[2] == seq:
+                del cache[key]
+                purged += 1
+        # 覆盖写入或LRU淘汰留下的旧记录过多时，按cache重建堆
+        if len(expire_heap) > 2 * len(cache) + 64:
+            expire_heap[:] = [(entry[0], entry[2], key) for key, entry in cache.items()]
+            heapq.heapify(expire_heap)
+        return purged
+
+    def _store(key, value, stamp):
+        with lock:
+            now = time.time()
+            seq = next(counter)
+            cache[key] = (now + ttl, value, seq, stamp)
+            cache.move_to_end(key)
+            heapq.heappush(expire_heap, (now + ttl, seq, key))
+            evicted = _purge(now)
+            if maxsize is not None:
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+                    evicted += 1
+            func_stats.change(entries=len(cache) - func_stats.entries, evictions=evicted)
+
+    def _refresh(key, tag_keys, args, kwargs):
+        try:
+            stamp = _TAGS.stamp(tag_keys)  # 执行前记录版本，执行期间失效的结果不会被当作有效
+            t0 = time.perf_counter()
+            value = user_function(*args, **kwargs)
+            func_stats.computed(time.perf_counter() - t0)
+        except Exception as e:
+            func_stats.refreshed(False)
+            warnings.warn(f'[{_make_msg(user_function)}]后台刷新失败，继续使用旧结果 {type(e)}:{e}', RuntimeWarning)
         else:
-            key = args
-
-        # in cpython, dict.get is thread-safe
-        result = cache_get(key, sentinel)
-        if result is not sentinel:
-            expire_at, value = result
-            if expire_at > time.time():
-                return value
-        value = user_function(*args, **kwargs)
-        cache[key] = (time.time() + ttl, value)
+            _store(key, value, stamp)
+            func_stats.refreshed(True)
+
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        key = _ttl_make_key(args, kwargs)
+        tag_keys = _resolve_tags(tags, args, kwargs)
+        with lock:
+            entry = cache.get(key)
+            now = time.time()
+            if entry is not None and entry[0] > now and (not tag_keys or _TAGS.stamp(tag_keys) == entry[3]):
+                cache.move_to_end(key)
+                stats[0] += 1
+                func_stats.hit(time.perf_counter() - t0)
+                if refresh is not None and now >= entry[0] - ttl + refresh:  # 软过期
+                    _REFRESHER.submit((wrapper, key), lambda: _refresh(key, tag_keys, args, kwargs))
+                return entry[1]
+            stats[1] += 1
+        func_stats.miss()
+
+        stamp = _TAGS.stamp(tag_keys)
+        t0 = time.perf_counter()
+        value = user_function(*args, **kwargs)  # 执行函数时不持有锁
+        func_stats.computed(time.perf_counter() - t0)
+        _store(key, value, stamp)
         return value
 
+    def cache_info():
+        with lock:
+            return _CacheInfo(stats[0], stats[1], maxsize, len(cache))
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            expire_heap.clear()
+            stats[:] = [0, 0]
+            func_stats.set_size(0)
+
+    def cache_invalidate(*args, **kwargs) -> bool:
+        """ 删除指定参数的缓存结果，返回是否存在 """
+        with lock:
+            existed = cache.pop(_ttl_make_key(args, kwargs), None) is not None
+            func_stats.set_size(len(cache))
+            return existed
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    wrapper.cache_invalidate = cache_invalidate
     return wrapper
 
 
@@ -131,13 +547,21 @@ def _ttl_cache_wrapper(user_function, ttl):
 def cache_safe(cls_or_func):
     """缓存装饰器： 线程安全，作用于类或函数，可用于实现 `缓存实例对象` """
     instances = {}
+    stats = AIUTILS_CACHE_STATS.get(_make_msg(cls_or_func), 'cache_safe')
 
     @_synchronized
     def get_instance(*args, **kw):
         # key = cls_or_func
+        t0 = time.perf_counter()
         key = _make_arguments_to_key(cls_or_func, *args, **kw)
         if key not in instances:
+            stats.miss()
+            t0 = time.perf_counter()
             instances[key] = cls_or_func(*args, **kw)
+            stats.computed(time.perf_counter() - t0)
+            stats.set_size(len(instances))
+        else:
+            stats.hit(time.perf_counter() - t0)
         return instances[key]
 
     return get_instance
@@ -154,23 +578,201 @@ def _synchronized(func):
     return synced_func
 
 
+# 可以直接repr的参数类型：repr结果稳定，不需要pickle
+_PRIMITIVE_TYPES = frozenset([
+    type(None), bool, int, float, complex, str, bytes,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+])
+
+
+_SigInfo = namedtuple('_SigInfo', 'sig bound_name names defaults')
+
+
+@lru_cache(maxsize=None)
+def _signature_of(method) -> _SigInfo:
+    """
+    缓存函数签名，避免每次调用都解析
+    * bound_name：第一个参数为self/cls时的参数名
+    * names defaults：只含普通参数(没有*args **kwargs 仅关键字参数)时记录，用于快速绑定
+    """
+    try:
+        sig = inspect.signature(method)
+    except (TypeError, ValueError):  # 部分内置函数没有签名
+        return _SigInfo(None, None, None, None)
+    params = list(sig.parameters.values())
+    bound_name = params[0].name if params and params[0].name in ('self', 'cls') else None
+    if all(p.kind == p.POSITIONAL_OR_KEYWORD for p in params):
+        names = tuple(p.name for p in params)
+        defaults = {p.name: p.default for p in params if p.default is not p.empty}
+    else:
+        names, defaults = None, None
+    return _SigInfo(sig, bound_name, names, defaults)
+
+
+def _bind_arguments(info: _SigInfo, args, kwargs) -> dict:
+    """ 按签名绑定参数(含默认值)；普通参数直接按位置组装，其它情况使用 Signature.bind """
+    names = info.names
+    if names is not None and len(args) <= len(names):
+        arguments = dict(zip(names, args))
+        for name in names[len(args):]:
+            if name in kwargs:
+                arguments[name] = kwargs[name]
+            elif name in info.defaults:
+                arguments[name] = info.defaults[name]
+            else:
+                break  # 缺少参数，交给bind抛出异常
+        else:
+            rest = names[len(args):]
+            if all(k in rest for k in kwargs):  # 没有多余或重复的关键字参数
+                return arguments
+    bound = info.sig.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.arguments
+
+
+def _is_primitive(value, depth=0) -> bool:
+    """ 参数是否为基础类型，或由基础类型组成的小容器 """
+    t = type(value)
+    if t in _PRIMITIVE_TYPES:
+        return True
+    if depth > 1:
+        return False
+    if t in (tuple, list, frozenset, set):
+        return len(value) <= 16 and all(_is_primitive(x, depth + 1) for x in value)
+    if t is dict:
+        return len(value) <= 16 and all(
+            type(k) in _PRIMITIVE_TYPES and _is_primitive(v, depth + 1) for k, v in value.items())
+    return False
+
+
+def _primitive_repr(value) -> str:
+    """ 基础类型的稳定repr：dict set 按元素repr排序 """
+    t = type(value)
+    if t is dict:
+        return 'dict(' + ','.join(sorted(f'{k!r}:{_primitive_repr(v)}' for k, v in value.items())) + ')'
+    if t in (set, frozenset):
+        return t.__name__ + '(' + ','.join(sorted(_primitive_repr(x) for x in value)) + ')'
+    if t in (tuple, list):
+        return t.__name__ + '(' + ','.join(_primitive_repr(x) for x in value) + ')'
+    return repr(value)
+
+
+def _array_digest(arr, h):
+    """ ndarray：shape dtype 以及数据内存做摘要；object类型无法直接读取内存，改为pickle """
+    import numpy as np
+    h.update(repr((arr.shape, arr.dtype.str)).encode())
+    if arr.dtype.hasobject:
+        h.update(pickle.dumps(arr, protocol=4))
+    else:
+        h.update(memoryview(np.ascontiguousarray(arr).reshape(-1).view(np.uint8)))
+
+
+def _fingerprint(value):
+    """
+    大对象转为摘要，避免整体pickle
+    * ndarray: blake2b(shape, dtype, 数据内存)
+    * DataFrame/Series: 列名、索引及各列数据分别摘要
+    * list/tuple/dict 递归处理，其它对象原样返回
+    """
+    t = type(value)
+    if t in _PRIMITIVE_TYPES:
+        return value
+    module = t.__module__
+    if module == 'numpy' and hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        h = hashlib.blake2b(digest_size=16)
+        _array_digest(value, h)
+        return '__ndarray__', h.hexdigest()
+    if module.startswith('pandas') and t.__name__ in ('DataFrame', 'Series'):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(t.__name__.encode())
+        _array_digest(value.index.to_numpy(), h)
+        if t.__name__ == 'Series':
+            h.update(repr(value.name).encode())
+            _array_digest(value.to_numpy(), h)
+        else:
+            h.update(repr(list(value.columns)).encode())
+            for _, col in value.items():
+                _array_digest(col.to_numpy(), h)
+        return '__' + t.__name__ + '__', h.hexdigest()
+    if t in (list, tuple):
+        return t(_fingerprint(x) for x in value)
+    if t is dict:
+        return {k: _fingerprint(v) for k, v in value.items()}
+    return value
+
+
+# self参数没有__cache_key__/__getstate__时的处理：'drop' 不参与key(同一类的全部实例共用缓存)；'raise' 抛出TypeError
+_SELF_KEY_POLICY = {'policy': 'warn'}
+_SELF_KEY_WARNED = set()  # 已提示过self不参与key的函数
+
+
+def set_self_key_policy(policy='warn'):
+    """
+    被装饰的方法，self没有定义 __cache_key__ 或 __getstate__ 时的处理
+    * 'warn' self不参与key，同一类的全部实例共用缓存结果；每个函数第一次出现时发出警告(默认)
+    * 'drop' 同'warn'，不发出警告(与旧版本一致)
+    * 'raise' 抛出TypeError，提示为该类定义 __cache_key__
+    """
+    if policy not in ('warn', 'drop', 'raise'):
+        raise ValueError(f"arg policy should in ['warn', 'drop', 'raise'] got {policy}")
+    _SELF_KEY_POLICY['policy'] = policy
+
+
+def _bound_token(value, method=None):
+    """
+    self/cls参数
+    * cls取类的限定名
+    * self：优先使用 self.__cache_key__()，其次为类自定义的 __getstate__()，结果按_fingerprint摘要；
+      不对整个对象pickle(self持有大对象时每次调用都很慢)，也不使用id(对象回收后地址会被复用)
+    * self没有以上方法时参考 set_self_key_policy
+    """
+    if isinstance(value, type):
+        return '__cls__', f"{value.__module__}.{value.__qualname__}"
+    t = type(value)
+    name = f"{t.__module__}.{t.__qualname__}"
+    hook = getattr(value, '__cache_key__', None)
+    if callable(hook):
+        return '__self__', name, _fingerprint(hook())
+    if getattr(t, '__getstate__', None) not in (None, getattr(object, '__getstate__', None)):
+        return '__self__', name, _fingerprint(value.__getstate__())
+    policy = _SELF_KEY_POLICY['policy']
+    if policy == 'raise':
+        raise TypeError(f'{name}没有定义__cache_key__或__getstate__，无法作为缓存key；参考 set_self_key_policy')
+    if policy == 'warn' and method is not None and method not in _SELF_KEY_WARNED:
+        _SELF_KEY_WARNED.add(method)
+        warnings.warn(f'[{_make_msg(method)}] {name}没有定义__cache_key__或__getstate__，self不参与缓存key，'
+                      f'全部实例共用缓存结果；参考 set_self_key_policy', UserWarning, stacklevel=2)
+    return None  # 不参与key
+
+
 def _make_arguments_to_key(method, *args, **kwargs):
-    arg_dict = inspect.getcallargs(method, *args, **kwargs)
-    # arg_dict = {str(method): args}  # method内存对象地址每次运行在变，不能用str(method)
-    # arg_dict.update(kwargs)
-
-    # 更新method相关属性-->保证唯一性
-    arg_dict.update(
-        {'__qualname__': method.__qualname__,  # 当前对象的所有父级对象的名称，以  “.” 连接
-         '__module__': method.__module__,
-         }
-    )
-    # FIXME被装饰函数包含self参数时存在问题。key只由后面参数确定,保留self cls出现TypeError: can't pickle module objects
-    arg_dict.pop('self', None)
-    arg_dict.pop('cls', None)
-    sorted_arg_dict = sorted(arg_dict.items())
-    key = hashlib.md5(pickle.dumps(sorted_arg_dict)).hexdigest()
-    return key
+    """
+    由函数及参数生成缓存key
+    * 函数签名只解析一次，按签名绑定参数(含默认值)，所以位置参数和关键字参数的写法得到同一个key
+    * 参数全部为基础类型时，直接对repr做摘要，不需要pickle
+    * ndarray DataFrame Series 参数，对其数据内存做摘要
+    * self/cls参数参与key，参考 _bound_token
+    """
+    info = _signature_of(method)
+    if info.sig is None:
+        arguments = {'args': args, 'kwargs': dict(sorted(kwargs.items()))}
+    else:
+        arguments = _bind_arguments(info, args, kwargs)
+        if info.bound_name is not None:
+            token = _bound_token(arguments[info.bound_name], method)
+            if token is None:
+                del arguments[info.bound_name]
+            else:
+                arguments[info.bound_name] = token
+
+    # method内存对象地址每次运行在变，不能用str(method)；使用限定名保证唯一性
+    h = hashlib.blake2b(f"{method.__module__}:{method.__qualname__}".encode(), digest_size=16)
+    if all(_is_primitive(v) for v in arguments.values()):
+        h.update(('r|' + '|'.join(f'{k}={_primitive_repr(v)}' for k, v in arguments.items())).encode())
+    else:
+        h.update(b'p')
+        h.update(pickle.dumps([(k, _fingerprint(v)) for k, v in arguments.items()], protocol=4))
+    return h.hexdigest()
 
 
 def _make_msg(method):
@@ -178,50 +780,689 @@ def _make_msg(method):
 
 
 # ------------------------------------------------------------------------------------------
+def _deep_sizeof(obj, _seen=None) -> int:
+    """
+    估算对象占用的字节数
+    * DataFrame/Series/Index：memory_usage(deep=True)
+    * ndarray：nbytes
+    * 容器(dict/list/tuple/set)及带有__dict__的对象：递归累加，同一对象只计算一次
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if type(obj).__module__.startswith('pandas') and hasattr(obj, 'memory_usage'):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'dtype'):  # numpy.ndarray及numpy标量
+        return int(obj.nbytes)
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, _seen) + _deep_sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(x, _seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += _deep_sizeof(obj.__dict__, _seen)
+    return size
+
+
+class _Shard(object):
+    """ 单个分片：独立的锁，OrderedDict记录LRU顺序，nbytes记录分片内结果的总字节数 """
+    __slots__ = ('lock', 'data', 'nbytes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = OrderedDict()  # key: [value, 字节数, 最近访问时间]
+        self.nbytes = 0
+
+
+class _ShardedStore(object):
+    """
+    分片存储：按 hash((fun, key)) 分配到N个分片，每个分片有独立的锁和LRU顺序
+    * 多线程读写不同的key时，只竞争各自分片的锁
+    * 记录每个结果的字节数及总字节数；超出预算时按最近访问时间淘汰，直到总字节数低于预算
+    * key约定为 (fun, ...)；kind不为空时，数量、字节数及淘汰按fun记录到AIUTILS_CACHE_STATS
+    """
+
+    def __init__(self, shards=16, kind=None):
+        if not isinstance(shards, int) or not shards > 0:
+            raise TypeError("Expected shards to be a positive integer")
+        self._shards = tuple(_Shard() for _ in range(shards))
+        self.kind = kind
+
+    def _notify(self, key, entries, nbytes, evictions=0):
+        if self.kind is not None:
+            AIUTILS_CACHE_STATS.get(_make_msg(key[0]), self.kind).change(entries, nbytes, evictions)
+
+    @property
+    def nbytes(self) -> int:
+        """ 当前缓存结果的总字节数 """
+        return sum(shard.nbytes for shard in self._shards)
+
+    def _shard(self, key) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            try:
+                entry = shard.data[key]
+            except KeyError:
+                return default
+            shard.data.move_to_end(key)  # 最近使用的放到末尾
+            entry[2] = time.time()
+            return entry[0]
+
+    def set(self, key, value, size=None, max_bytes=None) -> int:
+        """
+        写入结果，返回因超出预算而淘汰的数量
+        :param size: 结果的字节数；为None时通过_deep_sizeof估算
+        :param max_bytes: 总字节数预算；单个结果超出预算时不做缓存
+        """
+        if size is None:
+            size = _deep_sizeof(value)
+        if max_bytes is not None and size > max_bytes:
+            self.pop(key)
+            return 0
+
+        shard = self._shard(key)
+        with shard.lock:
+            old = shard.data.pop(key, None)
+            if old is not None:
+                shard.nbytes -= old[1]
+            shard.data[key] = [value, size, time.time()]
+            shard.nbytes += size
+        self._notify(key, 0 if old is not None else 1, size - (old[1] if old is not None else 0))
+
+        if max_bytes is None:
+            return 0
+        return self.evict(max_bytes, keep=key)
+
+    def evict(self, max_bytes, keep=None) -> int:
+        """ 按最近访问时间(全部分片中最久未使用的优先)淘汰，直到总字节数不超过max_bytes """
+        evicted = 0
+        while self.nbytes > max_bytes:
+            # 各分片的LRU队首即为该分片最久未使用的结果，从中选出最旧的
+            oldest, oldest_shard = None, None
+            for shard in self._shards:
+                with shard.lock:
+                    for k, entry in shard.data.items():
+                        if k == keep:
+                            continue
+                        if oldest is None or entry[2] < oldest[1]:
+                            oldest, oldest_shard = (k, entry[2]), shard
+                        break
+            if oldest is None:
+                break
+            with oldest_shard.lock:
+                entry = oldest_shard.data.pop(oldest[0], None)
+                if entry is not None:
+                    oldest_shard.nbytes -= entry[1]
+                    evicted += 1
+            if entry is not None:
+                self._notify(oldest[0], -1, -entry[1], evictions=1)
+        return evicted
+
+    def pop(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.data.pop(key, None)
+            if entry is None:
+                return default
+            shard.nbytes -= entry[1]
+        self._notify(key, -1, -entry[1])
+        return entry[0]
+
+    def clear(self, fun=None):
+        """ fun为空时清空全部；否则只清除该函数的缓存 """
+        for shard in self._shards:
+            with shard.lock:
+                removed = [(k, shard.data.pop(k)[1]) for k in list(shard.data) if fun is None or k[0] is fun]
+                shard.nbytes -= sum(size for _, size in removed)
+            for k, size in removed:
+                self._notify(k, -1, -size)
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self._shards)
+
+
+class _InFlight(object):
+    """ 正在执行中的一次调用 """
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SingleFlight(object):
+    """
+    请求合并：同一个key并发未命中时，只有第一个调用者执行，其余调用者等待它的结果或异常
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """ func为无参数的可调用对象 """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlight()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+
+class _ProcessFileLock(object):
+    """
+    跨进程的文件锁：以 O_CREAT|O_EXCL 创建锁文件，创建成功即获得锁
+    * 锁文件存在时轮询等待；超过timeout秒未更新的锁文件视为持有者已崩溃，删除后重新获取
+    * 锁文件内容为本次获取的token；释放时只删除内容仍为该token的锁文件，不删除其他进程已重新获取的锁
+    """
+
+    def __init__(self, lock_file, timeout=600):
+        self.lock_file = lock_file
+        self.timeout = timeout
+        self.token = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_file)), exist_ok=True)  # 目录可能在运行中被删除
+        interval = 0.05
+        while True:
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_file) > self.timeout:
+                        os.remove(self.lock_file)
+                        continue
+                except OSError:  # 等待期间锁文件被释放
+                    continue
+                time.sleep(interval)
+                interval = min(interval * 2, 0.5)
+            else:
+                self.token = f'{os.getpid()}:{uuid.uuid4().hex}'.encode()
+                os.write(fd, self.token)
+                os.close(fd)
+                return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            with open(self.lock_file, 'rb') as lock_fd:
+                owned = lock_fd.read() == self.token
+            if owned:
+                os.remove(self.lock_file)
+        except OSError:
+            pass
+
+
+def _is_empty_result(result) -> bool:
+    """ None、空的DataFrame/Series/ndarray、空容器 """
+    if result is None:
+        return True
+    if isinstance(result, (list, tuple, dict, set, frozenset, str, bytes)):
+        return len(result) == 0
+    if type(result).__module__.split('.')[0] in ('pandas', 'numpy'):
+        try:
+            return bool(result.size == 0)
+        except AttributeError:
+            return False
+    return False
+
+
+class _NegativeStore(object):
+    """
+    否定结果的缓存：None、空结果、指定的异常
+    * 进程内共用，与正常结果的缓存分开；每个被装饰函数按各自的maxsize限制数量，超出时淘汰该函数最久未使用的
+    * key为 (fun, key)；统计记录在 kind + '.negative'
+    """
+
+    def __init__(self):
+        self._data = {}  # fun: OrderedDict(key: (过期时间, 结果或异常, 是否异常, kind))
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ 返回 (结果或异常, 是否异常)；不存在或已过期时返回None """
+        with self._lock:
+            entries = self._data.get(key[0])
+            entry = entries.get(key) if entries is not None else None
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del entries[key]
+                AIUTILS_CACHE_STATS.get(_make_msg(key[0]), entry[3]).change(entries=-1)
+                return None
+            entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def set(self, key, value, is_exc, second, kind, maxsize):
+        evicted = []
+        with self._lock:
+            entries = self._data.setdefault(key[0], OrderedDict())
+            is_new = key not in entries
+            entries[key] = (time.time() + second, value, is_exc, kind)
+            entries.move_to_end(key)
+            while len(entries) > maxsize:
+                evicted.append(entries.popitem(last=False))
+        AIUTILS_CACHE_STATS.get(_make_msg(key[0]), kind).change(entries=int(is_new))
+        if evicted:
+            AIUTILS_CACHE_STATS.get(_make_msg(key[0]), kind).change(entries=-len(evicted), evictions=len(evicted))
+
+    def clear(self, fun=None):
+        with self._lock:
+            funs = [x for x in self._data if fun is None or x is fun]
+            removed = [(x, self._data.pop(x)) for x in funs]
+        for x, entries in removed:
+            if entries:
+                AIUTILS_CACHE_STATS.get(_make_msg(x), next(iter(entries.values()))[3]).change(entries=-len(entries))
+
+    def __len__(self):
+        return sum(len(x) for x in list(self._data.values()))
+
+
+_NEGATIVE_STORE = _NegativeStore()
+
+
+class _NegativeSpec(object):
+    """
+    被装饰函数的否定结果缓存设置
+    * second：缓存秒数，通常比正常结果短
+    * cache_empty：空的DataFrame/Series/容器也视为否定结果
+    * exceptions：需要缓存的异常类型，命中时再次抛出
+    * maxsize：每个被装饰函数最多缓存的否定结果数量
+    """
+    __slots__ = ('second', 'cache_empty', 'exceptions', 'kind', 'maxsize')
+
+    def __init__(self, second, cache_empty=False, exceptions=(), kind='MemoryCache', maxsize=10000):
+        if not second > 0:
+            raise ValueError("Expected negative_second to be positive")
+        if not maxsize > 0:
+            raise ValueError("Expected negative_maxsize to be positive")
+        self.second = second
+        self.cache_empty = cache_empty
+        self.exceptions = tuple(exceptions) if isinstance(exceptions, (list, tuple, set)) else (exceptions,)
+        self.kind = kind + '.negative'
+        self.maxsize = maxsize
+
+    @classmethod
+    def make(cls, second, cache_empty=False, exceptions=(), kind='MemoryCache', maxsize=10000):
+        """ second为None时不使用否定结果缓存，返回None """
+        return None if second is None else cls(second, cache_empty, exceptions, kind, maxsize)
+
+    def lookup(self, key):
+        """ 命中时返回 (True, 结果)，缓存的是异常时抛出；未命中返回 (False, None) """
+        t0 = time.perf_counter()
+        entry = _NEGATIVE_STORE.get(key)
+        if entry is None:
+            return False, None
+        AIUTILS_CACHE_STATS.get(_make_msg(key[0]), self.kind).hit(time.perf_counter() - t0)
+        value, is_exc = entry
+        if is_exc:
+            raise value.with_traceback(None)
+        return True, value
+
+    def call(self, key, fun, args, kwargs):
+        """ 执行函数；抛出指定的异常时缓存该异常 """
+        AIUTILS_CACHE_STATS.get(_make_msg(key[0]), self.kind).miss()
+        try:
+            return fun(*args, **kwargs)
+        except self.exceptions as e:
+            _NEGATIVE_STORE.set(key, e, True, self.second, self.kind, self.maxsize)
+            raise
+
+    def remember(self, key, result) -> bool:
+        """ 结果为否定结果时缓存，返回True；调用方不再按正常结果缓存 """
+        if result is None or (self.cache_empty and _is_empty_result(result)):
+            _NEGATIVE_STORE.set(key, result, False, self.second, self.kind, self.maxsize)
+            return True
+        return False
+
+
 class MemoryCache(object):
     """
     缓存在内存的装饰器
-    * 使用方式 @LocalCache.cached_function_result_for_a_time()
+    * 使用方式 @MemoryCache.cached_function_result_for_a_time()
     * 适用于数据过大时，控制内存不被占用太多。
     * 此处可缓存任何对象，不同于LocalCache(只能缓存可pickle的对象)
+    * 线程安全：结果存放在分片存储中，每个分片有独立的锁；own_store=True时该函数使用单独的存储
+    * 同一key并发未命中时只执行一次，其余线程等待该结果
+    * negative_second：缓存None(及可选的空结果、指定异常)，使用单独的存储及较短的缓存秒数，每个函数按negative_maxsize限制数量
+    * tags：依赖的标签；MemoryCache.invalidate(tag)后依赖该标签的结果失效
     """
     logger = Logger('MemoryCache')
-    func_result_dict = OrderedDict()
+    store = _ShardedStore(kind='MemoryCache')
+    negative_store = _NEGATIVE_STORE
+    _flight = _SingleFlight()
+    _own_stores = weakref.WeakSet()
+
+    @classmethod
+    def clear(cls):
+        """ 清空共用存储中的全部缓存 """
+        cls.store.clear()
+
+    @classmethod
+    def invalidate(cls, *tags):
+        """ 参考 invalidate """
+        invalidate(*tags)
+
+    @classmethod
+    def memory_usage(cls) -> int:
+        """ 当前缓存结果占用的字节数：共用存储及各函数单独的存储 """
+        return cls.store.nbytes + sum(x.nbytes for x in list(cls._own_stores))
 
     @classmethod
-    def cached_function_result_for_a_time(cls, cache_mb=2048, cache_second=60):
+    def cached_function_result_for_a_time(cls, cache_mb=2048, cache_second=60, own_store=False, shards=16,
+                                          refresh_second=None, negative_second=None, cache_empty=False,
+                                          cache_exceptions=(), tags=None, negative_maxsize=10000):
         """
-        :param cache_mb: 整个缓存器的最大内存
-        :param cache_second: 最长缓存秒数
+        :param cache_mb: 整个缓存器的最大内存(MB)；按结果的实际字节数估算，超出时淘汰最久未使用的结果
+        :param cache_second: 最长缓存秒数(硬过期)，超过时同步重新执行
+        :param own_store: 是否为该函数单独创建存储(独立的命名空间)；默认使用类共用的存储
+        :param shards: own_store=True时，单独存储的分片数量
+        :param refresh_second: 软过期秒数(小于cache_second)；超过时仍返回旧结果，同时在后台线程池重新执行；
+            后台执行失败时继续使用旧结果，并记录在统计的refresh_errors
+        :param negative_second: 否定结果(None)的缓存秒数；None不缓存(默认，与之前相同)
+        :param cache_empty: negative_second不为None时，空的DataFrame/Series/容器也按否定结果缓存
+        :param cache_exceptions: negative_second不为None时，需要缓存的异常类型，命中时再次抛出
+        :param tags: 依赖的标签列表，或以函数参数调用、返回标签列表的可调用对象；invalidate(tag)后失效
+        :param negative_maxsize: 该函数最多缓存的否定结果数量，超出时淘汰该函数最久未使用的
         :return:
         """
+        if refresh_second is not None and not 0 < refresh_second < cache_second:
+            raise ValueError("Expected refresh_second to be between 0 and cache_second")
+        negative = _NegativeSpec.make(negative_second, cache_empty, cache_exceptions, 'MemoryCache', negative_maxsize)
 
         def _cached_function_result_for_a_time(fun):
+            store = _ShardedStore(shards, kind='MemoryCache') if own_store else cls.store
+            if own_store:
+                cls._own_stores.add(store)
+            stats = AIUTILS_CACHE_STATS.get(_make_msg(fun), 'MemoryCache')
+
             @wraps(fun)
             def __cached_function_result_for_a_time(*args, **kwargs):
-                if sys.getsizeof(cls.func_result_dict) > cache_mb * 1024:
-                    # cls.func_result_dict.clear()
-                    cls.func_result_dict.popitem(last=False)  # 先进先出
-
+                t0 = time.perf_counter()
                 key = _make_arguments_to_key(fun, *args, **kwargs)
-                if (fun, key) in cls.func_result_dict and time.time() - cls.func_result_dict[(fun, key)][
-                    1] < cache_second:
+                tag_keys = _resolve_tags(tags, args, kwargs)
+                cached = store.get((fun, key))
+                if _valid(cached, tag_keys):
                     cls.logger.debug(f'[{_make_msg(fun)}]使用缓存[{key}]')
-                    return cls.func_result_dict[(fun, key)][0]
-                else:
-                    cls.logger.debug(f'[{_make_msg(fun)}]未使用缓存[{key}]')
+                    stats.hit(time.perf_counter() - t0)
+                    if refresh_second is not None and time.time() - cached[1] >= refresh_second:
+                        _REFRESHER.submit((fun, key), lambda: _refresh(key, tag_keys, args, kwargs))
+                    return cached[0]
+                if negative is not None:
+                    found, result = negative.lookup((fun, key))
+                    if found:
+                        cls.logger.debug(f'[{_make_msg(fun)}]使用否定结果缓存[{key}]')
+                        return result
+                cls.logger.debug(f'[{_make_msg(fun)}]未使用缓存[{key}]')
+                stats.miss()
+                return cls._flight.do((fun, key), lambda: _exec_and_store(key, tag_keys, args, kwargs))
+
+            def _valid(cached, tag_keys) -> bool:
+                """ 未过期，且依赖的标签没有失效 """
+                return cached is not None and time.time() - cached[1] < cache_second and \
+                    (not tag_keys or _TAGS.stamp(tag_keys) == cached[2])
+
+            def _refresh(key, tag_keys, args, kwargs):
+                try:
+                    stamp = _TAGS.stamp(tag_keys)
+                    t0 = time.perf_counter()
+                    result = fun(*args, **kwargs)
+                    stats.computed(time.perf_counter() - t0)
+                except Exception as e:
+                    stats.refreshed(False)
+                    cls.logger.warn(f'[{_make_msg(fun)}]后台刷新失败，继续使用旧结果[{key}] {type(e)}:{e}')
+                    return
+                if result is not None:
+                    store.set((fun, key), (result, time.time(), stamp), max_bytes=cache_mb * 1024 * 1024)
+                stats.refreshed(True)
+
+            def _exec_and_store(key, tag_keys, args, kwargs):
+                # 等待锁期间其它线程可能已写入
+                cached = store.get((fun, key))
+                if _valid(cached, tag_keys):
+                    return cached[0]
+                stamp = _TAGS.stamp(tag_keys)  # 执行前记录版本，执行期间失效的结果不会被当作有效
+                t0 = time.perf_counter()
+                if negative is None:
                     result = fun(*args, **kwargs)
-                    if result is not None:
-                        cls.func_result_dict[(fun, key)] = (result, time.time())
+                else:
+                    result = negative.call((fun, key), fun, args, kwargs)
+                stats.computed(time.perf_counter() - t0)
+                if negative is not None and negative.remember((fun, key), result):
                     return result
+                if result is not None:
+                    store.set((fun, key), (result, time.time(), stamp), max_bytes=cache_mb * 1024 * 1024)
+                return result
+
+            def cache_clear():
+                store.clear(fun)
+                _NEGATIVE_STORE.clear(fun)
 
+            __cached_function_result_for_a_time.cache_store = store
+            __cached_function_result_for_a_time.cache_clear = cache_clear
+            __cached_function_result_for_a_time.cache_nbytes = lambda: store.nbytes
             return __cached_function_result_for_a_time
 
         return _cached_function_result_for_a_time
 
 
 # ------------------------------------------------------------------------------------------
-def _read_pickle_cache(file, cache_second):
+# 列式存储：DataFrame/Series 结果可存为 Arrow IPC(feather) 或 parquet，读取时按文件头识别格式
+_ARROW_MAGIC = b'ARROW1'
+_PARQUET_MAGIC = b'PAR1'
+_SERIES_META = b'aiutils.series_name'
+# 内容寻址：key文件只记录blob的相对路径；blob按内容摘要命名，相同内容只存一份
+_REF_MAGIC = b'AIUREF1\n'
+_BLOB_DIR = '.blobs'
+# 压缩：文件头 + 压缩算法编号 + 压缩后的pickle
+_Z_MAGIC = b'AIUZ1'
+_CODECS = {'zlib': 1, 'lzma': 2, 'lz4': 3, 'zstd': 4}
+
+
+def _pickle_writer(result):
+    def write(path):
+        with open(path, 'wb') as cache_fd:
+            pickle.dump(result, cache_fd)
+
+    return write
+
+
+def _codec_functions(name):
+    """ 返回 (compress, decompress)；lz4 zstd 为可选依赖，未安装时抛出ImportError """
+    if name == 'zlib':
+        import zlib
+        return (lambda data: zlib.compress(data, 3)), zlib.decompress
+    if name == 'lzma':
+        import lzma
+        return lzma.compress, lzma.decompress
+    if name == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress, lz4.frame.decompress
+    if name == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress, (lambda data: zstandard.ZstdDecompressor().decompress(data))
+    raise ValueError(f'codec should in {list(_CODECS)} got {name}')
+
+
+def _codec_rules(codec, compress_min_bytes=64 * 1024) -> list:
+    """
+    压缩规则 [(最小字节数, 压缩算法)]，按最小字节数升序
+    :param codec: None不压缩；'auto'为已安装的最快算法(zstd lz4 zlib)；算法名称；或 [(最小字节数, 算法名称)]
+    :param compress_min_bytes: codec为单个算法时，pickle后达到该字节数才压缩
+    """
+    if codec is None:
+        return []
+    if codec == 'auto':
+        for name in ('zstd', 'lz4', 'zlib'):
+            try:
+                _codec_functions(name)
+            except ImportError:
+                continue
+            codec = name
+            break
+    rules = [(compress_min_bytes, codec)] if isinstance(codec, str) else sorted(codec)
+    for _, name in rules:
+        _codec_functions(name)  # 检查名称及依赖
+    return rules
+
+
+def _compressed_writer(result, rules):
+    """ pickle后按字节数选择压缩算法；未达到任何规则的字节数时不压缩 """
+    data = pickle.dumps(result)
+    name = None
+    for min_bytes, x in rules:
+        if len(data) >= min_bytes:
+            name = x
+
+    def write(path):
+        with open(path, 'wb') as cache_fd:
+            if name is None:
+                cache_fd.write(data)
+            else:
+                cache_fd.write(_Z_MAGIC + bytes([_CODECS[name]]))
+                cache_fd.write(_codec_functions(name)[0](data))
+
+    return write
+
+
+def _write_blob(cache_file, cache_dir, write_func):
+    """
+    内容寻址写入：写入blob(已存在相同内容时不再写入)，再写入指向blob的key文件；返回 (新增的字节数, blob路径)
+    * blob先写入临时文件再计算摘要，以摘要命名后os.replace，并发写入同一内容也是安全的
+    """
+    blob_dir = os.path.join(cache_dir, _BLOB_DIR)
+    os.makedirs(blob_dir, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=blob_dir, prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write_func(temp_file)
+        h = hashlib.blake2b(digest_size=20)
+        with open(temp_file, 'rb') as blob_fd:
+            for chunk in iter(lambda: blob_fd.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        blob = os.path.join(blob_dir, digest[:2], digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            size = 0
+            os.remove(temp_file)
+            os.utime(blob)  # 刷新修改时间，避免被gc_blobs当作无引用的旧blob
+        else:
+            size = os.path.getsize(temp_file)
+            os.replace(temp_file, blob)
+    except BaseException:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+
+    ref = _REF_MAGIC + os.path.relpath(blob, os.path.dirname(os.path.abspath(cache_file))).encode()
+
+    def write(path):
+        with open(path, 'wb') as cache_fd:
+            cache_fd.write(ref)
+
+    return size + _atomic_write(cache_file, write), blob
+
+
+def _blob_of(file):
+    """ key文件指向的blob路径；不是内容寻址的key文件时返回None """
+    with open(file, 'rb') as cache_fd:
+        head = cache_fd.read(4096)
+    if not head.startswith(_REF_MAGIC):
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(file)), head[len(_REF_MAGIC):].decode()))
+
+
+def _columnar_writer(result, df_format):
+    """
+    DataFrame/Series 的列式写入函数；不适用时返回None(改用pickle)
+    * 列名须全部为str，否则Arrow会转为str，读取后与原结果不一致
+    """
+    t = type(result)
+    if not (t.__module__.startswith('pandas') and t.__name__ in ('DataFrame', 'Series')):
+        return None
+    frame = result.to_frame(name='__series__') if t.__name__ == 'Series' else result
+    if not all(isinstance(x, str) for x in frame.columns):
+        return None
+    import pyarrow as pa
+    table = pa.Table.from_pandas(frame, preserve_index=True)
+    if t.__name__ == 'Series':
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), _SERIES_META: pickle.dumps(result.name)})
+
+    def write(path):
+        if df_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    return write
+
+
+def _load_cache_file(file, writable=False):
+    """
+    按文件头识别格式：Arrow IPC 及 parquet 使用内存映射读取，压缩的pickle先解压，其它按pickle读取
+    * 内容寻址的key文件，读取其指向的blob
+    * 内存映射得到的DataFrame/Series为只读；writable为True时返回其副本
+    """
+    with open(file, 'rb') as cache_fd:
+        magic = cache_fd.read(len(_REF_MAGIC))
+        if magic.startswith(_REF_MAGIC):
+            return _load_cache_file(_blob_of(file), writable)
+        if magic.startswith(_Z_MAGIC):
+            cache_fd.seek(len(_Z_MAGIC))
+            codec = {v: k for k, v in _CODECS.items()}[cache_fd.read(1)[0]]
+            return pickle.loads(_codec_functions(codec)[1](cache_fd.read()))
+        if not (magic.startswith(_ARROW_MAGIC) or magic.startswith(_PARQUET_MAGIC)):
+            cache_fd.seek(0)
+            return pickle.load(cache_fd)
+
+    import pyarrow as pa
+    if magic.startswith(_ARROW_MAGIC):
+        with pa.memory_map(file, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+    else:
+        import pyarrow.parquet as pq
+        table = pq.read_table(file, memory_map=True)
+    frame = table.to_pandas(split_blocks=True)
+    metadata = table.schema.metadata or {}
+    if _SERIES_META in metadata:
+        frame = frame['__series__'].rename(pickle.loads(metadata[_SERIES_META]))
+    return frame.copy() if writable else frame
+
+
+def _read_pickle_cache(file, cache_second, touch=False, writable=False):
+    """
+    :param touch: 读取成功后是否更新文件的访问时间(保留修改时间)，用于按最近访问淘汰
+    """
     if not os.path.isfile(file):
         raise RuntimeError(f'文件未创建')
     # 文件最近修改时间
@@ -234,53 +1475,333 @@ def _read_pickle_cache(file, cache_second):
 
     # 读取
     try:
-        with open(file, 'rb') as cache_fd:
-            result = pickle.load(cache_fd)
+        result = _load_cache_file(file, writable)
     except Exception as e:
         msg = f'文件读取失败[{file}]{type(e)}:{e}'  # 此情况 msg详细些
         warnings.warn(msg, UserWarning)
         raise e
     else:
+        if touch:
+            try:
+                os.utime(file, (time.time(), os.path.getmtime(file)))
+            except OSError:
+                pass
         return result
 
 
+def _atomic_write(cache_file, write_func) -> int:
+    """
+    先写入同目录的临时文件，再os.replace为目标文件，读取方不会读到写了一半的文件；返回文件字节数
+    * 目录在运行中被删除时，重新创建目录后再写入一次
+    :param write_func: write_func(临时文件路径)
+    """
+    try:
+        return _atomic_write_once(cache_file, write_func)
+    except FileNotFoundError:
+        cache_dir = os.path.dirname(cache_file)
+        if os.path.isdir(cache_dir):
+            raise
+        os.makedirs(cache_dir, exist_ok=True)
+        return _atomic_write_once(cache_file, write_func)
+
+
+def _atomic_write_once(cache_file, write_func) -> int:
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file),
+                                     prefix='.' + os.path.basename(cache_file), suffix='.tmp')
+    os.close(fd)
+    try:
+        write_func(temp_file)
+        size = os.path.getsize(temp_file)
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+    return size
+
+
+def _is_cache_file(name) -> bool:
+    """ 缓存文件：排除临时文件(.开头)及锁文件 """
+    return not name.startswith('.') and not name.endswith('.lock')
+
+
+class _CacheDirBudget(object):
+    """
+    缓存目录的大小预算
+    * 内存中累计写入的字节数，首次使用时扫描目录得到初始值
+    * 超出预算时扫描目录，按最近访问时间删除key文件，直到低于预算的90%
+    * 内容寻址的blob(dedup=True)只计一次字节数；不直接淘汰，引用它的key文件都删除后才删除
+    * 目录使用索引时(index不为None)，字节数及淘汰均为索引查询，不扫描目录
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.nbytes = None
+        self.index = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """ 返回 ([(访问时间, 字节数, key文件, blob)], {blob: (修改时间, 字节数)}) """
+        files, blobs = [], {}
+        for root, dirs, names in os.walk(self.cache_dir):
+            dirs[:] = [x for x in dirs if not x.startswith('.')]  # .blobs单独统计
+            for name in names:
+                if not _is_cache_file(name):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    blob = _blob_of(path) if st.st_size < 4096 else None  # key文件只有一行相对路径
+                except OSError:  # 扫描期间被删除
+                    continue
+                files.append((st.st_atime, st.st_size, path, blob))
+        for root, _, names in os.walk(os.path.join(self.cache_dir, _BLOB_DIR)):
+            for name in names:
+                if name.startswith('.'):  # 写入中的临时文件
+                    continue
+                path = os.path.normpath(os.path.join(root, name))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                blobs[path] = (st.st_mtime, st.st_size)
+        return files, blobs
+
+    def add(self, size) -> int:
+        """ 记录新写入的字节数，返回淘汰的key文件数量 """
+        if self.index is not None:
+            return self.index.evict(self.max_bytes)
+        with self._lock:
+            if self.nbytes is None:
+                files, blobs = self._scan()
+                self.nbytes = sum(x[1] for x in files) + sum(x[1] for x in blobs.values())
+            else:
+                self.nbytes += size
+            if self.nbytes <= self.max_bytes:
+                return 0
+            return self._evict()
+
+    def _evict(self) -> int:
+        files, blobs = self._scan()
+        files.sort(key=lambda x: x[:3])
+        refs = {}
+        for *_, blob in files:
+            if blob is not None:
+                refs[blob] = refs.get(blob, 0) + 1
+        total = sum(x[1] for x in files) + sum(x[1] for x in blobs.values())
+        target = self.max_bytes * 0.9
+        now = time.time()
+
+        def remove_blob(blob):
+            nonlocal total
+            mtime, size = blobs.pop(blob, (None, 0))
+            # 刚写入或刚被复用的blob可能有其他进程正在写入引用它的key文件
+            if mtime is None or now - mtime < _BLOB_GRACE_SECOND:
+                return
+            try:
+                os.remove(blob)
+            except OSError:
+                return
+            total -= size
+
+        for blob in [x for x in blobs if x not in refs]:
+            remove_blob(blob)
+        evicted = 0
+        for _, size, path, blob in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+            if blob is not None:
+                refs[blob] -= 1
+                if not refs[blob]:
+                    remove_blob(blob)
+        self.nbytes = total
+        return evicted
+
+
+class _PickleSweeper(threading.Thread):
+    """ 后台线程：定期删除已注册目录中的过期文件 """
+
+    def __init__(self, interval, dir_seconds):
+        super(_PickleSweeper, self).__init__(name='PickleCacheSweeper', daemon=True)
+        self.interval = interval
+        self.dirs = set()  # 按修改时间清理的目录
+        self.dir_seconds = dir_seconds  # 目录: 该目录中全部函数(不论是否清理)最长的缓存秒数
+        self.indexes = set()  # 使用索引的目录，按索引中的过期时间清理
+        self.stopped = threading.Event()
+
+    def register(self, path, interval, index=None):
+        if index is not None:
+            self.indexes.add(index)
+        else:
+            self.dirs.add(path)
+        self.interval = min(self.interval, interval)
+
+    def sweep(self) -> int:
+        removed = 0
+        now = time.time()
+        for index in list(self.indexes):
+            removed += index.purge_expired(now)
+        for path in list(self.dirs):
+            cache_second = self.dir_seconds[path]
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                # 只清理缓存文件及写入中断遗留的临时文件(.开头、.tmp结尾)；子目录(含.blobs)、锁文件、
+                # 标签文件(.tag_)、索引文件(.aiutils_index.sqlite)都不清理
+                stale_temp = entry.name.startswith('.') and entry.name.endswith('.tmp')
+                if not _is_cache_file(entry.name) and not stale_temp:
+                    continue
+                try:
+                    if not entry.is_file(follow_symlinks=False) or now - entry.stat().st_mtime < cache_second:
+                        continue
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    continue
+        return removed
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                PickleCache.logger.warn(f'清理过期缓存文件异常 {type(e)}:{e}')
+
+
+class _PickleSpec(object):
+    """
+    被装饰函数的文件缓存设置
+    * kind：统计中的缓存类型，执行耗时记录于此；disk_kind：文件数量及字节数记录于此
+    * negative：否定结果的缓存设置，None不缓存
+    * index：cache_dir的索引(CacheIndex)，None不使用
+    * dedup：是否内容寻址存储；codec_rules：pickle结果的压缩规则，参考 _codec_rules
+    """
+    __slots__ = ('cache_dir', 'child_dir', 'cache_second', 'process_lock', 'lock_timeout', 'df_format',
+                 'kind', 'disk_kind', 'negative', 'index', 'dedup', 'codec_rules', 'df_writable')
+
+    def __init__(self, cache_dir, child_dir='', cache_second=3600, process_lock=False, lock_timeout=600,
+                 df_format=None, kind='PickleCache', negative=None, use_index=False, dedup=False, codec=None,
+                 compress_min_bytes=64 * 1024, df_writable=False):
+        if df_format not in (None, 'feather', 'parquet'):
+            raise ValueError(f"df_format should in [None, 'feather', 'parquet'] got {df_format}")
+        self.cache_dir = cache_dir
+        self.child_dir = child_dir
+        self.cache_second = cache_second
+        self.process_lock = process_lock
+        self.lock_timeout = lock_timeout
+        self.df_format = df_format
+        self.kind = kind
+        self.disk_kind = kind if kind == 'PickleCache' else kind + '.disk'
+        self.negative = negative  # _NegativeSpec
+        self.index = CacheIndex.of(cache_dir) if use_index else None
+        self.dedup = dedup
+        self.codec_rules = _codec_rules(codec, compress_min_bytes)
+        self.df_writable = df_writable
+
+
 class PickleCache(object):
     """
     缓存到本地pickle文件
     * 使用方式 @LocalCache.cached_function_result_for_a_time()，可传入子路径
     * 对可pickle的对象，实现文件缓存
+    * 同一key并发未命中时只执行一次；process_lock=True时通过cache_dir中的锁文件，多进程之间也只执行一次
+    * df_format为'feather'或'parquet'时，DataFrame/Series结果使用列式存储(需要pyarrow)，读取时内存映射，结果为只读(首次执行也返回从文件读取的结果)；df_writable=True时返回副本；其它结果仍为pickle
+    * negative_second：否定结果不写文件，缓存在进程内的否定结果存储，参考MemoryCache
+    * tags：依赖的标签；invalidate(tag)更新cache_dir中的标签文件，修改时间早于标签文件的缓存文件视为失效(多进程有效)
+    * use_index=True时，cache_dir的SQLite索引记录每个文件的所属函数、字节数、过期时间等，
+      查找、按函数清空(cache_clear)、清理过期及淘汰都不需要遍历目录，参考CacheIndex
+    * dedup=True时内容寻址：key文件指向cache_dir/.blobs中按内容摘要命名的blob，相同结果只存一份；
+      不再被引用的blob由gc_blobs()删除
+    * codec：pickle结果的压缩算法，可按字节数选择不同算法；列式存储的结果不压缩
     """
     logger = Logger('PickleCache')
+    negative_store = _NEGATIVE_STORE
+    _flight = _SingleFlight()
+    _made_dirs = set()  # 已确认存在的目录，不再每次调用都检查
+    _budgets = {}  # 缓存文件所在目录: _CacheDirBudget
+    _sweeper = None
+    _dir_seconds = {}  # 缓存文件所在目录: 登记的最长缓存秒数，后台清理按此判断过期
+    _register_lock = threading.Lock()
 
     @classmethod
-    def cached_function_result_for_a_time(cls, cache_dir, child_dir='', cache_second=3600):
+    def cached_function_result_for_a_time(cls, cache_dir, child_dir='', cache_second=3600,
+                                          process_lock=False, lock_timeout=600,
+                                          cache_dir_mb=None, sweep_second=None, df_format=None,
+                                          negative_second=None, cache_empty=False, cache_exceptions=(), tags=None,
+                                          negative_maxsize=10000, use_index=False, dedup=False, codec=None, compress_min_bytes=64 * 1024,
+                                          df_writable=False):
+        """
+        :param cache_dir: 缓存主目录
+        :param child_dir: 子目录
+        :param cache_second: 最长缓存秒数
+        :param process_lock: 是否使用锁文件，让多个进程共享同一次执行结果
+        :param lock_timeout: 锁文件超过该秒数未释放，视为持有进程已崩溃
+        :param cache_dir_mb: 整个cache_dir的最大占用(MB)，超出时按最近访问时间删除文件；None不限制
+        :param sweep_second: 后台线程清理过期文件的间隔秒数；None不清理
+        :param df_format: DataFrame/Series结果的存储格式 None(pickle) 'feather' 'parquet'
+        :param df_writable: df_format列式存储的结果默认为只读(内存映射，首次执行也返回从文件读取的结果)；True时返回可修改的副本
+        :param negative_second: 否定结果(None)的缓存秒数，缓存在进程内；None不缓存
+        :param cache_empty: 参考MemoryCache
+        :param cache_exceptions: 参考MemoryCache
+        :param negative_maxsize: 参考MemoryCache
+        :param tags: 参考MemoryCache
+        :param use_index: 是否使用cache_dir的索引；同一cache_dir的全部写入方都应使用，已有文件可通过CacheIndex.rebuild登记
+        :param dedup: 是否内容寻址存储，相同内容的结果只存一份
+        :param codec: 压缩算法：None不压缩；'zlib' 'lzma'，已安装时可用 'lz4' 'zstd'；'auto'为已安装的最快算法；
+            或按字节数选择的规则 [(最小字节数, 算法名称)]，例如 [(64 * 1024, 'lz4'), (256 * 1024 * 1024, 'zlib')]
+        :param compress_min_bytes: codec为单个算法时，pickle后达到该字节数才压缩
+        :return:
+        """
+        spec = _PickleSpec(cache_dir, child_dir, cache_second, process_lock, lock_timeout, df_format,
+                           negative=_NegativeSpec.make(negative_second, cache_empty, cache_exceptions, 'PickleCache',
+                                                        negative_maxsize),
+                           use_index=use_index, dedup=dedup, codec=codec, compress_min_bytes=compress_min_bytes,
+                           df_writable=df_writable)
+
         def _cached_function_result_for_a_time(fun):
+            cls._register(cache_dir, child_dir, cache_second, cache_dir_mb, sweep_second, spec.index)
+            if tags is not None:
+                _TAGS.dirs.add(cache_dir)
+            stats = AIUTILS_CACHE_STATS.get(_make_msg(fun), 'PickleCache')
+
             @wraps(fun)
             def __cached_function_result_for_a_time(*args, **kwargs):
-                # 缓存主目录
-                if not os.path.isdir(cache_dir):
-                    os.makedirs(cache_dir)
-
                 # 生成key
+                t0 = time.perf_counter()
                 key = _make_arguments_to_key(fun, *args, **kwargs)
-                # 查找文件
-                if child_dir:
-                    temp_dir = os.path.join(cache_dir, child_dir)  # 指定localCache的子目录时
-                    if not os.path.isdir(temp_dir):
-                        os.makedirs(temp_dir)
-                    cache_file = os.path.join(temp_dir, key)
-                else:
-                    cache_file = os.path.join(cache_dir, key)
+                cache_file = cls._cache_file(cache_dir, child_dir, key)
+                tag_keys = _resolve_tags(tags, args, kwargs)
+
+                # 否定结果
+                if spec.negative is not None:
+                    found, result = spec.negative.lookup((fun, cache_file))
+                    if found:
+                        cls.logger.debug(f'[{_make_msg(fun)}]使用否定结果缓存[{key}]')
+                        return result
 
                 # 读取缓存文件
                 try:
-                    result = _read_pickle_cache(cache_file, cache_second)
+                    result = cls._read(cache_file, spec, tag_keys)
                 except Exception as e:
                     msg = f'[{_make_msg(fun)}]未使用pickle缓存[{key}]：[{str(e)}]'
                     cls.logger.debug(msg)
-                    result = cls.exec_func_and_pickle(cache_file, fun, *args, **kwargs)
+                    stats.miss()
+                    result = cls._flight.do(
+                        cache_file, lambda: cls._exec_shared(cache_file, spec, fun, args, kwargs, tag_keys))
                 else:
                     cls.logger.debug(f'[{_make_msg(fun)}]使用pickle缓存[{key}]')
+                    stats.hit(time.perf_counter() - t0)
 
                 # 最后返回结果
                 return result
@@ -308,20 +1829,331 @@ class PickleCache(object):
                 # result = cls.exec_func_and_pickle(cache_file, fun, *args, **kwargs)
                 # return result
 
+            if spec.index is not None:
+                stats.set_size(*spec.index.owner_size(_make_msg(fun)))
+                __cached_function_result_for_a_time.cache_index = spec.index
+                __cached_function_result_for_a_time.cache_clear = lambda: spec.index.clear(owner=_make_msg(fun))
+
             # -----以下为wrapper的return-----
             return __cached_function_result_for_a_time
 
         return _cached_function_result_for_a_time
 
+    @classmethod
+    def _register(cls, cache_dir, child_dir, cache_second, cache_dir_mb=None, sweep_second=None, index=None):
+        """ 装饰时登记目录的大小预算及过期清理；index为cache_dir的索引 """
+        temp_dir = os.path.abspath(os.path.join(cache_dir, child_dir) if child_dir else cache_dir)
+        with cls._register_lock:
+            cls._dir_seconds[temp_dir] = max(cache_second, cls._dir_seconds.get(temp_dir, 0))
+            if cache_dir_mb is not None:
+                root = os.path.abspath(cache_dir)
+                budget = next((x for x in cls._budgets.values() if x.cache_dir == root), None)
+                if budget is None:
+                    budget = _CacheDirBudget(root, cache_dir_mb * 1024 * 1024)
+                budget.max_bytes = min(budget.max_bytes, cache_dir_mb * 1024 * 1024)
+                budget.index = budget.index or index
+                cls._budgets[os.path.abspath(temp_dir)] = budget
+            if sweep_second is not None:
+                if cls._sweeper is None:
+                    cls._sweeper = _PickleSweeper(sweep_second, cls._dir_seconds)
+                    cls._sweeper.start()
+                cls._sweeper.register(temp_dir, sweep_second, index)
+
+    @classmethod
+    def invalidate(cls, *tags):
+        """ 参考 invalidate """
+        invalidate(*tags)
+
+    @classmethod
+    def gc_blobs(cls, cache_dir, grace_second=3600) -> int:
+        """
+        删除cache_dir中不再被任何key文件引用的blob(dedup=True时产生)；返回删除的数量
+        * 使用索引时按索引中的记录查找key文件，否则遍历目录
+        :param grace_second: 修改时间在该秒数内的blob不删除，避免删除刚写入、key文件尚未写入的blob
+        """
+        root = os.path.abspath(cache_dir)
+        blob_root = os.path.join(root, _BLOB_DIR)
+        index = CacheIndex.opened(root)
+        if index is not None:
+            files = index.files()
+        else:
+            files = []
+            for path, dirs, names in os.walk(root):
+                dirs[:] = [x for x in dirs if x != _BLOB_DIR]
+                files.extend(os.path.join(path, x) for x in names if _is_cache_file(x))
+        referenced = set()
+        for file in files:
+            try:
+                blob = _blob_of(file)
+            except OSError:
+                continue
+            if blob is not None:
+                referenced.add(blob)
+
+        removed, now = [], time.time()
+        for path, _, names in os.walk(blob_root):
+            for name in names:
+                blob = os.path.join(path, name)
+                try:
+                    if blob in referenced or now - os.path.getmtime(blob) < grace_second:
+                        continue
+                    os.remove(blob)
+                    removed.append(blob)
+                except OSError:
+                    continue
+        if index is not None:
+            index.discard_blobs(removed)
+        return len(removed)
+
+    @classmethod
+    def stop_sweeper(cls):
+        """ 停止后台清理线程 """
+        with cls._register_lock:
+            if cls._sweeper is not None:
+                cls._sweeper.stopped.set()
+                cls._sweeper = None
+
+    @classmethod
+    def _cache_file(cls, cache_dir, child_dir, key):
+        """ 缓存文件路径；目录不存在时创建(每个目录只检查一次) """
+        temp_dir = os.path.join(cache_dir, child_dir) if child_dir else cache_dir  # 指定localCache的子目录时
+        if temp_dir not in cls._made_dirs:
+            os.makedirs(temp_dir, exist_ok=True)
+            cls._made_dirs.add(temp_dir)
+        return os.path.join(temp_dir, key)
+
+    @classmethod
+    def _read(cls, cache_file, spec: _PickleSpec, tag_keys=()):
+        """ 读取缓存文件；目录设置了大小预算时，更新访问时间；tag_keys为依赖的标签 """
+        if spec.index is not None:
+            return cls._read_indexed(cache_file, spec, tag_keys)
+        if tag_keys:
+            mtime = os.path.getmtime(cache_file)
+            for x in tag_keys:
+                try:
+                    if os.path.getmtime(_tag_file(spec.cache_dir, x)) >= mtime:
+                        raise RuntimeError(f'标签已失效[{x}]')
+                except OSError:  # 标签从未失效过
+                    pass
+        touch = os.path.abspath(os.path.dirname(cache_file)) in cls._budgets
+        return _read_pickle_cache(cache_file, spec.cache_second, touch=touch, writable=spec.df_writable)
+
+    @classmethod
+    def _read_indexed(cls, cache_file, spec: _PickleSpec, tag_keys=()):
+        """ 按索引判断是否存在及过期，不对缓存文件stat """
+        row = spec.index.get(cache_file)
+        if row is None:
+            raise RuntimeError('索引中没有记录')
+        _, created, _, expire = row
+        if expire is not None and expire <= time.time():
+            raise RuntimeError('文件已过期')
+        for x in tag_keys:
+            try:
+                if os.path.getmtime(_tag_file(spec.cache_dir, x)) >= created:
+                    raise RuntimeError(f'标签已失效[{x}]')
+            except OSError:  # 标签从未失效过
+                pass
+        try:
+            result = _load_cache_file(cache_file, spec.df_writable)
+        except FileNotFoundError:
+            spec.index.discard(cache_file)
+            raise
+        spec.index.touch(cache_file)
+        return result
+
+    @classmethod
+    def _exec_shared(cls, cache_file, spec: _PickleSpec, fun, args, kwargs, tag_keys=()):
+        """ 未命中时的唯一执行者：先再次读取(其它线程或进程可能刚写完)，仍未命中才执行函数 """
+        try:
+            return cls._read(cache_file, spec, tag_keys)
+        except Exception:
+            pass
+        if not spec.process_lock:
+            return cls._exec_and_write(cache_file, spec, fun, args, kwargs, tag_keys)
+
+        with _ProcessFileLock(cache_file + '.lock', spec.lock_timeout):
+            try:
+                return cls._read(cache_file, spec, tag_keys)
+            except Exception:
+                return cls._exec_and_write(cache_file, spec, fun, args, kwargs, tag_keys)
+
     @classmethod
     def exec_func_and_pickle(cls, cache_file, fun, *args, **kwargs):
-        result = fun(*args, **kwargs)
+        return cls._exec_and_write(cache_file, None, fun, args, kwargs)
+
+    @classmethod
+    def _exec_and_write(cls, cache_file, spec, fun, args, kwargs, tag_keys=()):
+        negative = spec.negative if spec is not None else None
+        started = time.time()
+        t0 = time.perf_counter()
+        if negative is None:
+            result = fun(*args, **kwargs)
+        else:
+            result = negative.call((fun, cache_file), fun, args, kwargs)
+        kind = spec.kind if spec is not None else 'PickleCache'
+        AIUTILS_CACHE_STATS.get(_make_msg(fun), kind).computed(time.perf_counter() - t0)
+        if negative is not None and negative.remember((fun, cache_file), result):
+            return result
         if result is not None:
+            columnar = cls._write(cache_file, result, spec, fun, created=started if tag_keys else None)
+            if tag_keys and (spec is None or spec.index is None):
+                # 修改时间设为开始执行的时间：执行期间标签失效时，该结果也视为失效；使用索引时记录为创建时间
+                try:
+                    os.utime(cache_file, (time.time(), started))
+                except OSError:
+                    pass
+            if columnar and not spec.df_writable:
+                # 与命中时一致：返回从文件内存映射读取的只读结果
+                try:
+                    result = _load_cache_file(cache_file)
+                except Exception:
+                    pass
+        return result
+
+    @classmethod
+    def _write(cls, cache_file, result, spec, fun, created=None):
+        """
+        写入缓存文件：df_format适用时列式存储，失败或不适用时pickle
+        :param created: 使用索引时记录的创建时间；None为当前时间
+        :return: 是否为列式存储
+        """
+        index = spec.index if spec is not None else None
+        old_size = None
+        if index is None:
+            try:
+                old_size = os.path.getsize(cache_file)  # 覆盖已过期的文件
+            except OSError:
+                pass
+        writer = None
+        if spec is not None and spec.df_format is not None:
             try:
-                with open(cache_file, 'wb') as cache_fd:
-                    pickle.dump(result, cache_fd)
+                writer = _columnar_writer(result, spec.df_format)
             except Exception as e:
-                msg = '[{}]结果pickle失败[{}]'.format(fun.__name__, str(e))
-                warnings.warn(msg, RuntimeWarning)
+                cls.logger.debug(f'[{_make_msg(fun)}]列式存储不可用，改用pickle [{type(e)}:{e}]')
 
-        return result
+        def pickle_writer():
+            if spec is not None and spec.codec_rules:
+                return _compressed_writer(result, spec.codec_rules)
+            return _pickle_writer(result)
+
+        blob = None
+
+        def write(write_func):
+            nonlocal blob
+            if spec is not None and spec.dedup:
+                nbytes, blob = _write_blob(cache_file, spec.cache_dir, write_func)
+                return nbytes
+            return _atomic_write(cache_file, write_func)
+
+        columnar = writer is not None
+        try:
+            try:
+                size = write(writer or pickle_writer())
+            except Exception:
+                if writer is None:
+                    raise
+                columnar = False
+                size = write(pickle_writer())
+        except Exception as e:
+            msg = '[{}]结果pickle失败[{}]'.format(fun.__name__, str(e))
+            warnings.warn(msg, RuntimeWarning)
+            return False
+        else:
+            if index is not None:
+                old_size = index.put(cache_file, _make_msg(fun), size, time.time() + spec.cache_second, created, blob)
+            AIUTILS_CACHE_STATS.get(_make_msg(fun), spec.disk_kind if spec is not None else 'PickleCache').change(
+                entries=0 if old_size is not None else 1, nbytes=size - (old_size or 0))
+            budget = cls._budgets.get(os.path.abspath(os.path.dirname(cache_file)))
+            if budget is not None:
+                evicted = budget.add(size)
+                if evicted:
+                    AIUTILS_CACHE_STATS.get(budget.cache_dir, 'PickleCache.dir').change(evictions=evicted)
+            return columnar
+
+
+# ------------------------------------------------------------------------------------------
+class TieredCache(object):
+    """
+    两级缓存：内存(L1) + pickle文件(L2)
+    * 使用方式 @TieredCache.cached_function_result_for_a_time(cache_dir)
+    * key只计算一次；先查内存，再查文件，文件命中时写入内存
+    * 未命中时执行函数，结果同时写入内存和文件
+    * 每个被装饰函数有单独的内存存储，两级分别设置缓存秒数及大小；内存中的结果不超过文件的过期时间
+    """
+    logger = Logger('TieredCache')
+    _flight = _SingleFlight()
+
+    @staticmethod
+    def _file_expire(cache_file, spec: _PickleSpec) -> float:
+        """ 缓存文件的过期时间：使用索引时为索引中的记录，否则为修改时间加缓存秒数 """
+        if spec.index is not None:
+            row = spec.index.get(cache_file)
+            if row is not None and row[3] is not None:
+                return row[3]
+        return os.path.getmtime(cache_file) + spec.cache_second
+
+    @classmethod
+    def cached_function_result_for_a_time(cls, cache_dir, child_dir='', memory_mb=512, memory_second=60,
+                                          disk_second=3600, disk_mb=None, sweep_second=None,
+                                          process_lock=False, lock_timeout=600, df_format=None, df_writable=False):
+        """
+        :param cache_dir: L2缓存主目录
+        :param child_dir: L2子目录
+        :param memory_mb: L1最大内存(MB)
+        :param memory_second: L1最长缓存秒数
+        :param disk_second: L2最长缓存秒数
+        :param disk_mb: L2整个cache_dir的最大占用(MB)，参考PickleCache的cache_dir_mb
+        :param sweep_second: 参考PickleCache
+        :param process_lock: 参考PickleCache
+        :param lock_timeout: 参考PickleCache
+        :param df_format: 参考PickleCache
+        :param df_writable: 参考PickleCache
+        :return:
+        """
+        spec = _PickleSpec(cache_dir, child_dir, disk_second, process_lock, lock_timeout, df_format,
+                           kind='TieredCache', df_writable=df_writable)
+
+        def _cached_function_result_for_a_time(fun):
+            store = _ShardedStore(kind='TieredCache')
+            PickleCache._register(cache_dir, child_dir, disk_second, disk_mb, sweep_second)
+            stats = AIUTILS_CACHE_STATS.get(_make_msg(fun), 'TieredCache')
+
+            @wraps(fun)
+            def __cached_function_result_for_a_time(*args, **kwargs):
+                t0 = time.perf_counter()
+                key = _make_arguments_to_key(fun, *args, **kwargs)
+                cached = store.get((fun, key))
+                if cached is not None and time.time() - cached[1] < memory_second:
+                    cls.logger.debug(f'[{_make_msg(fun)}]使用内存缓存[{key}]')
+                    stats.hit(time.perf_counter() - t0)
+                    return cached[0]
+                cache_file = PickleCache._cache_file(cache_dir, child_dir, key)
+                return cls._flight.do(cache_file, lambda: _load_or_exec(key, cache_file, t0, args, kwargs))
+
+            def _load_or_exec(key, cache_file, t0, args, kwargs):
+                cached = store.get((fun, key))
+                if cached is not None and time.time() - cached[1] < memory_second:
+                    return cached[0]
+                try:
+                    result = PickleCache._read(cache_file, spec)
+                    expire = cls._file_expire(cache_file, spec)
+                except Exception as e:
+                    cls.logger.debug(f'[{_make_msg(fun)}]未使用缓存[{key}]：[{str(e)}]')
+                    stats.miss()
+                    result = PickleCache._exec_shared(cache_file, spec, fun, args, kwargs)
+                    expire = time.time() + disk_second
+                else:
+                    cls.logger.debug(f'[{_make_msg(fun)}]使用pickle缓存[{key}]，写入内存')
+                    stats.hit(time.perf_counter() - t0)
+                if result is not None:
+                    # 内存中的缓存不超过文件的剩余时间：写入时间前移，使其与文件同时过期
+                    written = min(time.time(), expire - memory_second)
+                    store.set((fun, key), (result, written), max_bytes=memory_mb * 1024 * 1024)
+                return result
+
+            __cached_function_result_for_a_time.cache_store = store
+            __cached_function_result_for_a_time.cache_clear = lambda: store.clear(fun)
+            __cached_function_result_for_a_time.cache_nbytes = lambda: store.nbytes
+            return __cached_function_result_for_a_time
+
+        return _cached_function_result_for_a_time
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+@file: cache_index.py
+PickleCache的SQLite索引：每个cache_dir一个索引文件
+
+* 记录每个缓存文件的 key、所属函数(owner)、子目录、字节数、创建/访问/过期时间
+* 查找、统计、按函数清空、清理过期、按访问时间淘汰都是索引查询，不需要遍历目录(在NFS等网络目录上很慢)
+* 读取时更新的访问时间先累积在内存中，批量写入索引
+* 同一cache_dir的全部写入方都应使用索引，否则索引中没有记录的文件视为未命中
+* 内容寻址(dedup=True)的key文件记录所指向的blob；blob单独登记，字节数只计一次，不再被引用时随key文件一起删除
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from logbook import Logger
+
+_INDEX_FILE = '.aiutils_index.sqlite'  # '.'开头：不计入缓存文件
+_BLOB_GRACE_SECOND = 60  # 修改时间在该秒数内的blob不删除：其他进程可能刚写入引用它的key文件，尚未登记
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    owner TEXT,
+    child_dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    expire REAL,
+    blob TEXT
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_owner ON entries (owner);
+CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS idx_entries_expire ON entries (expire);
+CREATE INDEX IF NOT EXISTS idx_entries_blob ON entries (blob);
+"""
+
+
+class CacheIndex(object):
+    """
+    cache_dir的索引
+    * 使用方式 CacheIndex.of(cache_dir)，同一目录在进程内共用一个实例
+    * path为缓存文件相对cache_dir的路径
+    """
+    logger = Logger('CacheIndex')
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, cache_dir, flush_second=5, flush_size=256):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.index_file = os.path.join(self.cache_dir, _INDEX_FILE)
+        self.flush_second = flush_second
+        self.flush_size = flush_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._touched = {}  # path: 访问时间，未写入索引
+        self._flushed_at = time.time()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = self._conn()
+        if 'blob' not in {x[1] for x in conn.execute('PRAGMA table_info(entries)')}:  # 旧版本的索引文件
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name='entries'").fetchone():
+                conn.execute('ALTER TABLE entries ADD COLUMN blob TEXT')
+        conn.executescript(_SCHEMA)
+
+    @classmethod
+    def of(cls, cache_dir) -> 'CacheIndex':
+        root = os.path.abspath(cache_dir)
+        index = cls._instances.get(root)
+        if index is None:
+            with cls._instances_lock:
+                index = cls._instances.get(root)
+                if index is None:
+                    index = cls._instances[root] = cls(root)
+        return index
+
+    @classmethod
+    def opened(cls, cache_dir):
+        """ 进程内已打开的索引；没有时返回None，不创建索引文件 """
+        return cls._instances.get(os.path.abspath(cache_dir))
+
+    def _conn(self) -> sqlite3.Connection:
+        """ 每个线程一个连接；自动提交，需要事务时显式BEGIN """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.index_file, timeout=60, isolation_level=None)
+        return conn
+
+    def path_of(self, cache_file) -> str:
+        return os.path.relpath(os.path.abspath(cache_file), self.cache_dir)
+
+    # 单个记录 ----------------------------------------------------------------------------------------
+    def get(self, cache_file):
+        """ 返回 (size, created, accessed, expire)；不存在时返回None """
+        return self._conn().execute(
+            'SELECT size, created, accessed, expire FROM entries WHERE path=?', (self.path_of(cache_file),)
+        ).fetchone()
+
+    def put(self, cache_file, owner, size, expire=None, created=None, blob=None):
+        """
+        写入缓存文件后登记；返回该文件原来的字节数，不存在时为None
+        :param blob: 内容寻址时key文件指向的blob；此时size只记key文件本身，blob的字节数单独登记一次
+        """
+        path = self.path_of(cache_file)
+        now = time.time()
+        child_dir, key = os.path.split(path)
+        if blob is not None:
+            size, blob_size, blob = os.path.getsize(cache_file), os.path.getsize(blob), self.path_of(blob)
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute('SELECT size FROM entries WHERE path=?', (path,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (path, key, owner, child_dir, size, created or now, now, expire, blob))
+            if blob is not None:
+                conn.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?)', (blob, blob_size))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self._touched.pop(path, None)
+        return old[0] if old else None
+
+    def touch(self, cache_file):
+        """ 记录访问时间；累积到flush_size条或flush_second秒后批量写入 """
+        now = time.time()
+        with self._lock:
+            self._touched[self.path_of(cache_file)] = now
+            due = len(self._touched) >= self.flush_size or now - self._flushed_at >= self.flush_second
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._flushed_at = time.time()
+        if touched:
+            self._conn().executemany('UPDATE entries SET accessed=? WHERE path=?',
+                                     [(t, p) for p, t in touched.items()])
+
+    def files(self) -> list:
+        """ 已登记的全部缓存文件(绝对路径) """
+        return [os.path.join(self.cache_dir, x[0]) for x in self._conn().execute('SELECT path FROM entries')]
+
+    def discard_blobs(self, blobs):
+        """ blob已被删除时删除记录；blobs为绝对路径 """
+        self._conn().executemany('DELETE FROM blobs WHERE path=?', [(self.path_of(x),) for x in blobs])
+
+    def discard(self, cache_file):
+        """ 文件已不存在时删除记录 """
+        self._conn().execute('DELETE FROM entries WHERE path=?', (self.path_of(cache_file),))
+
+    # 批量操作 ----------------------------------------------------------------------------------------
+    def _remove(self, rows) -> int:
+        """ 删除文件及记录，再删除不再被引用的blob；rows为 [(path,)]，返回删除的key文件数量 """
+        removed = self._remove_files('entries', rows)
+        self._remove_files('blobs', self._unreferenced_blobs())
+        return removed
+
+    def _remove_files(self, table, rows) -> int:
+        removed = 0
+        for (path,) in rows:
+            try:
+                os.remove(os.path.join(self.cache_dir, path))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.warn(f'删除缓存文件失败[{path}] {type(e)}:{e}')
+                continue
+            removed += 1
+        self._conn().executemany(f'DELETE FROM {table} WHERE path=?', rows)
+        return removed
+
+    def _unreferenced_blobs(self):
+        """ 没有被任何key文件引用的blob [(path,)] """
+        referenced = {x[0] for x in self._conn().execute('SELECT DISTINCT blob FROM entries WHERE blob IS NOT NULL')}
+        rows, now = [], time.time()
+        for (path,) in self._conn().execute('SELECT path FROM blobs'):
+            if path in referenced:
+                continue
+            try:
+                if now - os.path.getmtime(os.path.join(self.cache_dir, path)) < _BLOB_GRACE_SECOND:
+                    continue
+            except FileNotFoundError:
+                pass
+            rows.append((path,))
+        return rows
+
+    def clear(self, owner=None, child_dir=None) -> int:
+        """ 按所属函数及子目录清空；均为None时清空整个目录 """
+        sql, params = 'SELECT path FROM entries WHERE 1=1', []
+        if owner is not None:
+            sql, params = sql + ' AND owner=?', params + [owner]
+        if child_dir is not None:
+            sql, params = sql + ' AND child_dir=?', params + [child_dir]
+        return self._remove(self._conn().execute(sql, params).fetchall())
+
+    def purge_expired(self, now=None) -> int:
+        """ 删除已过期的文件 """
+        rows = self._conn().execute('SELECT path FROM entries WHERE expire<=?', (now or time.time(),)).fetchall()
+        return self._remove(rows)
+
+    def nbytes(self) -> int:
+        """ 整个目录缓存文件的总字节数，含blob(每个blob只计一次) """
+        return self._conn().execute('SELECT (SELECT COALESCE(SUM(size), 0) FROM entries) + '
+                                    '(SELECT COALESCE(SUM(size), 0) FROM blobs)').fetchone()[0]
+
+    def owner_size(self, owner):
+        """ 所属函数的 (数量, 字节数)；字节数不含blob """
+        count, size = self._conn().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE owner=?', (owner,)).fetchone()
+        return count, size
+
+    def evict(self, max_bytes, ratio=0.9) -> int:
+        """
+        超出max_bytes时，按最近访问时间删除key文件，直到低于max_bytes*ratio；返回删除的key文件数量
+        * 删除key文件后，blob不再被引用时一并删除，其字节数才计入释放
+        """
+        total = self.nbytes()
+        if total <= max_bytes:
+            return 0
+        self.flush()
+        conn = self._conn()
+        entries = conn.execute('SELECT path, size, blob FROM entries ORDER BY accessed').fetchall()
+        blob_size = dict(conn.execute('SELECT path, size FROM blobs'))
+        refs = {}
+        for _, _, blob in entries:
+            if blob is not None:
+                refs[blob] = refs.get(blob, 0) + 1
+        total -= sum(size for blob, size in blob_size.items() if blob not in refs)  # 已无引用的blob
+        rows, target = [], max_bytes * ratio
+        for path, size, blob in entries:
+            if total <= target:
+                break
+            rows.append((path,))
+            total -= size
+            if blob is not None:
+                refs[blob] -= 1
+                if not refs[blob]:
+                    total -= blob_size.get(blob, 0)
+        return self._remove(rows)
+
+    def usage(self):
+        """ 按所属函数及子目录统计：数量、字节数(不含blob)、最早创建、最近访问，返回DataFrame """
+        import pandas as pd
+        self.flush()
+        rows = self._conn().execute(
+            'SELECT owner, child_dir, COUNT(*), SUM(size), MIN(created), MAX(accessed) '
+            'FROM entries GROUP BY owner, child_dir').fetchall()
+        df = pd.DataFrame(rows, columns=['owner', 'child_dir', 'entries', 'nbytes', 'created', 'accessed'])
+        for col in ('created', 'accessed'):
+            df[col] = pd.to_datetime(df[col], unit='s')
+        return df
+
+    def rebuild(self, cache_second=None) -> int:
+        """
+        遍历一次目录，登记索引中没有的缓存文件(所属函数未知)；用于已有目录开始使用索引时
+        * 内容寻址的key文件同时登记其指向的blob
+        :param cache_second: 过期时间按文件修改时间加该秒数；None不过期
+        :return: 登记的文件数量
+        """
+        from aiutils.cache import _blob_of, _is_cache_file
+        known = {x[0] for x in self._conn().execute('SELECT path FROM entries')}
+        rows, blobs = [], {}
+        for root, dirs, names in os.walk(self.cache_dir):
+            dirs[:] = [x for x in dirs if not x.startswith('.')]  # 例如内容寻址的.blobs
+            for name in names:
+                if not _is_cache_file(name):
+                    continue
+                file = os.path.join(root, name)
+                path = self.path_of(file)
+                if path in known:
+                    continue
+                try:
+                    st = os.stat(file)
+                    blob = _blob_of(file)
+                    if blob is not None:
+                        blobs[self.path_of(blob)] = os.path.getsize(blob)
+                        blob = self.path_of(blob)
+                except OSError:
+                    continue
+                child_dir, key = os.path.split(path)
+                expire = st.st_mtime + cache_second if cache_second is not None else None
+                rows.append((path, key, None, child_dir, st.st_size, st.st_mtime, st.st_atime, expire, blob))
+        self._conn().executemany('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._conn().executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?)', list(blobs.items()))
+        return len(rows)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+@file: cache_segment.py
+按日期分段的缓存：用于 (code, start, end) 形式的数据读取函数
+
+* 请求的日期范围按频率切分为对齐的分段(参考 dt_convert.split_dates_more)，每个分段单独缓存
+* 日期范围平移时，只需读取缺少的分段；可设置线程数并行读取
+* 分段缓存在内存或cache_dir的文件中；结果按日期拼接后截取请求的范围
+* 包含今天的分段(未结束的分段)使用较短的缓存秒数，且与结束后的分段分别保存，分段结束后重新读取
+"""
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+import pandas as pd
+from logbook import Logger
+
+from aiutils.cache import (
+    _make_arguments_to_key, _make_msg, _PickleSpec, _ShardedStore, _signature_of, _SingleFlight, PickleCache,
+)
+from aiutils.cache_stats import AIUTILS_CACHE_STATS
+from aiutils.dt_convert import split_dates_more, split_dates_tolist, to_date
+
+
+def _segments(start, end, freq):
+    """ 覆盖 [start, end] 的对齐分段 [(分段开始, 分段结束)]，日期为datetime.date；不含end之后开始的分段 """
+    end = to_date(end)
+    return [x for x in split_dates_tolist(split_dates_more(to_date(start), end, freq)) if x[0] <= end]
+
+
+def _like(value, date: datetime.date, is_end=False):
+    """
+    分段日期转为调用方传入的类型：str(保持分隔符)、int(yyyymmdd)、datetime、pd.Timestamp，其它为datetime.date
+    * datetime、pd.Timestamp：分段开始为当天0点，分段结束(is_end)为当天最后时刻，读取函数按闭区间包含结束当天的全部时间
+    """
+    if isinstance(value, pd.Timestamp):
+        ts = pd.Timestamp(date, tz=value.tz)
+        return ts + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns') if is_end else ts
+    if isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(date, datetime.time.max if is_end else datetime.time(), tzinfo=value.tzinfo)
+    if isinstance(value, str):
+        if value.isdigit():
+            return date.strftime('%Y%m%d')
+        return date.strftime('%Y/%m/%d' if '/' in value else '%Y-%m-%d')
+    if isinstance(value, int) and not isinstance(value, bool):
+        return int(date.strftime('%Y%m%d'))
+    return date
+
+
+def _bound(value, is_end=False) -> pd.Timestamp:
+    """ 截取范围的边界：datetime、pd.Timestamp保留时间；其它按日期，结束为次日0点(不包含) """
+    if isinstance(value, datetime.datetime):
+        return pd.Timestamp(value)
+    ts = pd.Timestamp(to_date(value))
+    return ts + pd.Timedelta(days=1) if is_end else ts
+
+
+def _slice_dates(result, start, end, date_col=None):
+    """ 按调用方传入的 [start, end] 截取：date_col为None时使用索引；日期类型的end包含当天的全部时间 """
+    dates = result.index if date_col is None else result[date_col]
+    dates = pd.to_datetime(dates)
+    upper = _bound(end, is_end=True)
+    mask = (dates >= _bound(start)) & ((dates <= upper) if isinstance(end, datetime.datetime) else (dates < upper))
+    return result[mask.values if hasattr(mask, 'values') else mask]
+
+
+class SegmentCache(object):
+    """
+    按日期分段缓存 (code, start, end) 形式的数据读取函数
+    * 使用方式 @SegmentCache.cached_function_result_for_a_time(freq='W')
+    * 被装饰函数的前三个参数(self/cls除外)为 代码、开始日期、结束日期，可通过arg_names指定；其它参数参与key
+    * 读取分段时，开始日期、结束日期与调用方传入的类型相同(参考_like)；分段按整天读取，结果按调用方传入的时间截取
+    * 未结束的分段(包含今天及之后的日期)与已结束的分段分别保存：未结束时缓存的数据不完整，分段结束后重新读取
+    * 返回DataFrame或Series，日期在索引或date_col列中
+    * cache_dir为None时缓存在内存，否则缓存为cache_dir中的文件(参考PickleCache)
+    """
+    logger = Logger('SegmentCache')
+    _flight = _SingleFlight()
+
+    @classmethod
+    def cached_function_result_for_a_time(cls, freq='W', cache_second=3600 * 24 * 7, open_second=300,
+                                          date_col=None, arg_names=None, workers=1,
+                                          cache_dir=None, child_dir='', cache_dir_mb=None, sweep_second=None,
+                                          df_format=None, memory_mb=1024):
+        """
+        :param freq: 分段频率，例如 'W'；月、季、年的写法取决于pandas版本('M' 'Q' 'Y' 或 'ME' 'QE' 'YE')
+        :param cache_second: 已结束分段的缓存秒数
+        :param open_second: 包含今天及之后日期的分段(未结束)的缓存秒数
+        :param date_col: 日期所在的列；None为索引
+        :param arg_names: (代码, 开始日期, 结束日期) 的参数名；None为前三个参数
+        :param workers: 并行读取缺少分段的线程数
+        :param cache_dir: 文件缓存主目录；None缓存在内存
+        :param child_dir: 文件缓存子目录
+        :param cache_dir_mb: 参考PickleCache
+        :param sweep_second: 参考PickleCache
+        :param df_format: 参考PickleCache
+        :param memory_mb: 缓存在内存时的最大内存(MB)
+        :return:
+        """
+        if not 0 < open_second <= cache_second:
+            raise ValueError("Expected open_second to be between 0 and cache_second")
+        if cache_dir is not None:
+            closed_spec = _PickleSpec(cache_dir, child_dir, cache_second, df_format=df_format, kind='SegmentCache')
+            open_spec = _PickleSpec(cache_dir, child_dir, open_second, df_format=df_format, kind='SegmentCache')
+
+        def _cached_function_result_for_a_time(fun):
+            info = _signature_of(fun)
+            if info.sig is None:
+                raise TypeError(f'[{_make_msg(fun)}]无法解析函数签名')
+            if arg_names is None:
+                names = [x for x in info.sig.parameters if x != info.bound_name][:3]
+                if len(names) < 3:
+                    raise TypeError(f'[{_make_msg(fun)}]前三个参数应为 代码、开始日期、结束日期')
+            else:
+                names = list(arg_names)
+            _, start_name, end_name = names
+            store = _ShardedStore(kind='SegmentCache') if cache_dir is None else None
+            if cache_dir is not None:
+                PickleCache._register(cache_dir, child_dir, cache_second, cache_dir_mb, sweep_second)
+            stats = AIUTILS_CACHE_STATS.get(_make_msg(fun), 'SegmentCache')
+
+            @wraps(fun)
+            def __cached_function_result_for_a_time(*args, **kwargs):
+                bound = info.sig.bind(*args, **kwargs)
+                bound.apply_defaults()
+                start, end = bound.arguments[start_name], bound.arguments[end_name]
+                today = datetime.date.today()
+
+                # 读取已缓存的分段，记录缺少的分段
+                parts, missing = {}, []
+                for seg in _segments(start, end, freq):
+                    t0 = time.perf_counter()
+                    bound.arguments[start_name] = _like(start, seg[0])
+                    bound.arguments[end_name] = _like(end, seg[1], is_end=True)
+                    is_open = seg[1] >= today
+                    key = _make_arguments_to_key(fun, *bound.args, **bound.kwargs) + ('.open' if is_open else '')
+                    found, result = _get(key, is_open)
+                    if found:
+                        stats.hit(time.perf_counter() - t0)
+                        parts[seg] = result
+                    else:
+                        stats.miss()
+                        missing.append((seg, key, is_open, bound.args, bound.kwargs))
+
+                # 读取缺少的分段
+                if missing:
+                    cls.logger.debug(f'[{_make_msg(fun)}]缺少分段{[x[0] for x in missing]}')
+                    if workers > 1 and len(missing) > 1:
+                        with ThreadPoolExecutor(min(workers, len(missing))) as pool:
+                            results = list(pool.map(lambda x: _load(*x[1:]), missing))
+                    else:
+                        results = [_load(*x[1:]) for x in missing]
+                    for x, result in zip(missing, results):
+                        parts[x[0]] = result
+
+                # 拼接并截取
+                frames = [parts[seg] for seg in sorted(parts) if parts[seg] is not None]
+                if not frames:
+                    return None
+                result = frames[0] if len(frames) == 1 else pd.concat(frames)
+                return _slice_dates(result, start, end, date_col)
+
+            def _get(key, is_open):
+                """ 返回 (是否命中, 结果) """
+                if store is not None:
+                    cached = store.get((fun, key))  # 未结束的分段key带有'.open'后缀，与结束后的分段分开
+                    if cached is not None and time.time() - cached[1] < (open_second if is_open else cache_second):
+                        return True, cached[0]
+                    return False, None
+                cache_file = PickleCache._cache_file(cache_dir, child_dir, key)
+                try:
+                    return True, PickleCache._read(cache_file, open_spec if is_open else closed_spec)
+                except Exception:
+                    return False, None
+
+            def _load(key, is_open, args, kwargs):
+                """ 读取一个分段，同一分段并发时只执行一次 """
+
+                def run():
+                    found, result = _get(key, is_open)
+                    if found:
+                        return result
+                    t0 = time.perf_counter()
+                    result = fun(*args, **kwargs)
+                    stats.computed(time.perf_counter() - t0)
+                    if result is None:
+                        return None
+                    if not isinstance(result, (pd.DataFrame, pd.Series)):
+                        raise TypeError(f'[{_make_msg(fun)}]分段缓存要求返回DataFrame或Series，得到{type(result)}')
+                    if store is not None:
+                        store.set((fun, key), (result, time.time()), max_bytes=memory_mb * 1024 * 1024)
+                        if not is_open:
+                            store.pop((fun, key + '.open'))  # 未结束时缓存的不完整分段
+                    else:
+                        cache_file = PickleCache._cache_file(cache_dir, child_dir, key)
+                        PickleCache._write(cache_file, result, open_spec if is_open else closed_spec, fun)
+                    return result
+
+                return cls._flight.do((fun, key), run)
+
+            def cache_clear():
+                """ 清空内存中的分段；文件缓存请删除cache_dir """
+                if store is not None:
+                    store.clear(fun)
+
+            __cached_function_result_for_a_time.cache_clear = cache_clear
+            return __cached_function_result_for_a_time
+
+        return _cached_function_result_for_a_time
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+@file: cache_shm.py
+跨进程的共享内存缓存：同一台机器的多个进程共用一份结果
+
+* 结果存放在 multiprocessing.shared_memory 中：ndarray及DataFrame/Series中数值、时间列的数据按原样存放，
+  读取时直接映射为只读视图(不复制)；其它列及其它对象pickle后存放，读取时反序列化
+* 索引：index_dir中每个key一个meta文件(段名、布局、过期时间、引用的进程)，通过锁文件互斥
+* 引用计数：记录映射了该段的进程id；段过期且没有存活的进程引用时删除，崩溃进程的引用由sweep()清理
+* 段的生命周期由本模块管理，不交给resource_tracker(否则创建进程退出时会删除仍在使用的段)
+"""
+import atexit
+import os
+import pickle
+import tempfile
+import threading
+import time
+from functools import wraps
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from logbook import Logger
+
+from aiutils.cache import (
+    _atomic_write, _make_arguments_to_key, _make_msg, _pickle_writer, _ProcessFileLock, _SingleFlight,
+)
+from aiutils.cache_stats import AIUTILS_CACHE_STATS
+
+_ALIGN = 64  # 每块数据的对齐字节数
+_RAW_KINDS = 'biufcmM'  # 按原样存放的dtype类别：布尔、整数、浮点、复数、时间差、时间
+
+
+def _pid_alive(pid) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # 进程存在，属于其它用户
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class _SharedMemory(shared_memory.SharedMemory):
+    """ 仍有视图在使用时(例如进程退出)不关闭，由操作系统解除映射 """
+
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass
+
+
+def _untrack(shm):
+    """ 不让resource_tracker在本进程退出时删除该段 """
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _unlink(name):
+    """ 删除段；已不存在时忽略 """
+    try:
+        shm = _SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+# 布局 ------------------------------------------------------------------------------------------------
+class _Layout(object):
+    """ 把结果拆分为若干块，计算每块在段中的偏移 """
+
+    def __init__(self):
+        self.chunks = []  # (偏移, ndarray或bytes)
+        self.size = 0
+
+    def _add(self, data, nbytes) -> int:
+        offset = self.size
+        self.chunks.append((offset, data))
+        self.size += (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+        return offset
+
+    def array(self, arr):
+        if isinstance(arr.dtype, np.dtype) and arr.dtype.kind in _RAW_KINDS:
+            arr = np.ascontiguousarray(arr)
+            return 'array', self._add(arr, arr.nbytes), arr.dtype.str, arr.shape
+        return self.pickle(arr)
+
+    def pickle(self, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        return 'pickle', self._add(data, len(data)), len(data)
+
+    def write(self, buf):
+        for offset, data in self.chunks:
+            if isinstance(data, np.ndarray):
+                np.ndarray(data.shape, data.dtype, buffer=buf, offset=offset)[...] = data
+            else:
+                buf[offset:offset + len(data)] = data
+
+
+def _encode(value, layout: _Layout):
+    """ 返回描述，数据块记录在layout中 """
+    import pandas as pd
+    if isinstance(value, np.ndarray):
+        return 'ndarray', layout.array(value)
+    if isinstance(value, pd.DataFrame):
+        cols = [layout.array(value.iloc[:, i].to_numpy()) if isinstance(value.dtypes.iloc[i], np.dtype)
+                else layout.pickle(value.iloc[:, i].array) for i in range(value.shape[1])]
+        return 'frame', cols, _encode_index(value.index, layout), layout.pickle(value.columns)
+    if isinstance(value, pd.Series):
+        col = layout.array(value.to_numpy()) if isinstance(value.dtype, np.dtype) else layout.pickle(value.array)
+        return 'series', col, _encode_index(value.index, layout), value.name
+    return 'object', layout.pickle(value)
+
+
+def _encode_index(index, layout: _Layout):
+    import pandas as pd
+    if type(index) in (pd.Index, pd.DatetimeIndex) and isinstance(index.dtype, np.dtype) \
+            and index.dtype.kind in _RAW_KINDS:
+        return 'index', layout.array(index.to_numpy()), index.name
+    return 'object', layout.pickle(index)
+
+
+def _read_block(block, buf):
+    if block[0] == 'array':
+        _, offset, dtype, shape = block
+        # frombuffer持有段的导出引用，视图未释放时段无法关闭(close抛出BufferError)，避免映射被提前解除
+        dtype = np.dtype(dtype)
+        arr = np.frombuffer(buf, dtype, count=int(np.prod(shape, dtype=np.int64)), offset=offset).reshape(shape)
+        arr.flags.writeable = False
+        return arr
+    _, offset, nbytes = block
+    return pickle.loads(buf[offset:offset + nbytes])
+
+
+def _decode(desc, buf):
+    """ 由描述及段的内存还原结果；数值列为只读视图 """
+    import pandas as pd
+    kind = desc[0]
+    if kind == 'ndarray':
+        return _read_block(desc[1], buf)
+    if kind == 'frame':
+        _, cols, index, columns = desc
+        arrays = {i: _read_block(x, buf) for i, x in enumerate(cols)}
+        df = pd.DataFrame(arrays, index=_decode_index(index, buf), copy=False)
+        df.columns = _read_block(columns, buf)
+        return df
+    if kind == 'series':
+        _, col, index, name = desc
+        return pd.Series(_read_block(col, buf), index=_decode_index(index, buf), name=name, copy=False)
+    return _read_block(desc[1], buf)
+
+
+def _decode_index(desc, buf):
+    import pandas as pd
+    if desc[0] == 'index':
+        return pd.Index(_read_block(desc[1], buf), name=desc[2], copy=False)
+    return _read_block(desc[1], buf)
+
+
+# 索引 ------------------------------------------------------------------------------------------------
+def _read_meta(meta_file):
+    try:
+        with open(meta_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_meta(meta_file, meta):
+    _atomic_write(meta_file, _pickle_writer(meta))
+
+
+def _prune(meta) -> int:
+    """ 去掉已退出进程的引用，删除没有引用的旧段；返回删除的段数 """
+    meta['pids'] = {x for x in meta['pids'] if _pid_alive(x)}
+    retired, removed = [], 0
+    for name, pids in meta['retired']:
+        pids = {x for x in pids if _pid_alive(x)}
+        if pids:
+            retired.append((name, pids))
+        else:
+            _unlink(name)
+            removed += 1
+    meta['retired'] = retired
+    return removed
+
+
+class _Attachment(object):
+    """ 本进程映射的段及还原的结果 """
+    __slots__ = ('key', 'value', 'expire', 'shm', 'meta_file')
+
+    def __init__(self, key, value, expire, shm, meta_file):
+        self.key = key
+        self.value = value
+        self.expire = expire
+        self.shm = shm
+        self.meta_file = meta_file
+
+
+class SharedMemoryCache(object):
+    """
+    跨进程的共享内存缓存
+    * 使用方式 @SharedMemoryCache.cached_function_result_for_a_time()
+    * 适用于多个进程(例如回测的进程池)都需要的大型ndarray/DataFrame：每台机器只存一份，各进程只读映射
+    * 返回的数值数据为只读视图，需要修改时请先copy()
+    * 同一key在进程之间只执行一次(锁文件)，进程内并发未命中也只执行一次
+    """
+    logger = Logger('SharedMemoryCache')
+    index_dir = os.path.join(tempfile.gettempdir(), 'aiutils_shm')
+    _attached = {}  # key: _Attachment
+    _retired = []  # 本进程已替换、但返回的视图可能仍在使用的 _Attachment
+    _lock = threading.Lock()
+    _flight = _SingleFlight()
+    _swept_dirs = set()
+
+    @classmethod
+    def cached_function_result_for_a_time(cls, cache_second=3600, index_dir=None, lock_timeout=600):
+        """
+        :param cache_second: 最长缓存秒数；过期后重新执行，旧段在没有进程引用时删除
+        :param index_dir: 索引目录，同一台机器的进程需使用同一目录；None为系统临时目录下的aiutils_shm
+        :param lock_timeout: 锁文件超过该秒数未释放，视为持有进程已崩溃
+        :return:
+        """
+        index_dir = index_dir or cls.index_dir
+
+        def _cached_function_result_for_a_time(fun):
+            os.makedirs(index_dir, exist_ok=True)
+            if index_dir not in cls._swept_dirs:
+                cls._swept_dirs.add(index_dir)
+                cls.sweep(index_dir, lock_timeout)
+            stats = AIUTILS_CACHE_STATS.get(_make_msg(fun), 'SharedMemoryCache')
+
+            @wraps(fun)
+            def __cached_function_result_for_a_time(*args, **kwargs):
+                t0 = time.perf_counter()
+                key = _make_arguments_to_key(fun, *args, **kwargs)
+                att = cls._attached.get(key)
+                if att is not None and att.expire > time.time():
+                    stats.hit(time.perf_counter() - t0)
+                    return att.value
+                value = cls._flight.do(key, lambda: _load(key, t0, args, kwargs))
+                if cls._retired:  # 不持有锁文件时，关闭已替换的段
+                    cls.release()
+                return value
+
+            def _load(key, t0, args, kwargs):
+                meta_file = os.path.join(index_dir, key + '.meta')
+                with _ProcessFileLock(os.path.join(index_dir, key + '.lock'), lock_timeout):
+                    meta = _read_meta(meta_file)
+                    if meta is not None and meta['expire'] > time.time():
+                        try:
+                            value = cls._attach(key, meta, meta_file)
+                        except FileNotFoundError:  # 段已被删除(例如机器重启后残留的meta)
+                            cls.logger.debug(f'[{_make_msg(fun)}]共享内存段不存在[{meta["name"]}]')
+                        else:
+                            cls.logger.debug(f'[{_make_msg(fun)}]使用共享内存缓存[{key}]')
+                            stats.hit(time.perf_counter() - t0)
+                            return value
+
+                    cls.logger.debug(f'[{_make_msg(fun)}]未使用共享内存缓存[{key}]')
+                    stats.miss()
+                    t0 = time.perf_counter()
+                    result = fun(*args, **kwargs)
+                    stats.computed(time.perf_counter() - t0)
+                    if result is None:
+                        return None
+                    try:
+                        return cls._create(key, result, meta, meta_file, cache_second, stats)
+                    except Exception as e:
+                        cls.logger.warn(f'[{_make_msg(fun)}]写入共享内存失败 {type(e)}:{e}')
+                        return result
+
+            return __cached_function_result_for_a_time
+
+        return _cached_function_result_for_a_time
+
+    @classmethod
+    def _create(cls, key, result, meta, meta_file, cache_second, stats):
+        """ 创建段并写入结果，更新meta；返回映射该段得到的只读结果。调用方持有锁文件 """
+        layout = _Layout()
+        desc = _encode(result, layout)
+        name = f'aiu{key[:20]}{os.getpid() % 0x10000:04x}{int(time.time() * 1000) % 0x10000:04x}'
+        shm = _SharedMemory(name=name, create=True, size=max(layout.size, 1))
+        _untrack(shm)
+        try:
+            layout.write(shm.buf)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        new_meta = {'name': name, 'desc': desc, 'size': layout.size, 'expire': time.time() + cache_second,
+                    'pids': {os.getpid()}, 'retired': []}
+        old_size = None
+        if meta is not None:
+            old_size = meta['size']
+            new_meta['retired'] = meta['retired'] + [(meta['name'], meta['pids'])]
+            _prune(new_meta)
+        _write_meta(meta_file, new_meta)
+        stats.change(entries=0 if old_size is not None else 1, nbytes=layout.size - (old_size or 0))
+        return cls._keep(_Attachment(key, _decode(desc, shm.buf), new_meta['expire'], shm, meta_file))
+
+    @classmethod
+    def _attach(cls, key, meta, meta_file):
+        """ 映射已有的段，登记本进程的引用。调用方持有锁文件 """
+        shm = _SharedMemory(name=meta['name'])
+        _untrack(shm)
+        value = _decode(meta['desc'], shm.buf)
+        if os.getpid() not in meta['pids']:
+            meta['pids'].add(os.getpid())
+            _write_meta(meta_file, meta)
+        return cls._keep(_Attachment(key, value, meta['expire'], shm, meta_file))
+
+    @classmethod
+    def _keep(cls, att):
+        with cls._lock:
+            old = cls._attached.get(att.key)
+            cls._attached[att.key] = att
+            if old is not None and old.shm.name != att.shm.name:
+                old.value = None
+                cls._retired.append(old)
+        return att.value
+
+    @classmethod
+    def release(cls, everything=False) -> int:
+        """
+        关闭本进程已替换的段中、返回的视图都已释放的段，并从meta中去掉本进程的引用；返回关闭的段数
+        :param everything: 同时关闭当前映射的段(例如进程退出时)
+        """
+        with cls._lock:
+            if everything:
+                for att in cls._attached.values():
+                    att.value = None
+                cls._retired.extend(cls._attached.values())
+                cls._attached.clear()
+            candidates, cls._retired = cls._retired, []
+        closed, busy = [], []
+        for att in candidates:
+            try:
+                att.shm.close()
+            except BufferError:  # 还有视图在使用
+                busy.append(att)
+            else:
+                closed.append(att)
+        with cls._lock:
+            cls._retired.extend(busy)
+        for att in closed:
+            cls._drop_pid(att)
+        return len(closed)
+
+    @classmethod
+    def _drop_pid(cls, att):
+        lock_file = att.meta_file[:-len('.meta')] + '.lock'
+        try:
+            with _ProcessFileLock(lock_file):
+                meta = _read_meta(att.meta_file)
+                if meta is None:
+                    return
+                pid, name = os.getpid(), att.shm.name
+                if meta['name'] == name:
+                    meta['pids'].discard(pid)
+                meta['retired'] = [(n, pids - {pid} if n == name else pids) for n, pids in meta['retired']]
+                _prune(meta)
+                _write_meta(att.meta_file, meta)
+        except OSError as e:
+            cls.logger.debug(f'更新共享内存引用失败[{att.meta_file}] {type(e)}:{e}')
+
+    @classmethod
+    def sweep(cls, index_dir=None, lock_timeout=600) -> int:
+        """
+        清理index_dir：去掉已退出进程的引用，删除没有引用的旧段，以及已过期且没有引用的段；返回删除的段数
+        """
+        index_dir = index_dir or cls.index_dir
+        removed = 0
+        try:
+            names = os.listdir(index_dir)
+        except FileNotFoundError:
+            return 0
+        for file in names:
+            if not file.endswith('.meta') or file.startswith('.'):
+                continue
+            meta_file = os.path.join(index_dir, file)
+            with _ProcessFileLock(meta_file[:-len('.meta')] + '.lock', lock_timeout):
+                meta = _read_meta(meta_file)
+                if meta is None:
+                    continue
+                removed += _prune(meta)
+                if meta['expire'] <= time.time() and not meta['pids']:
+                    _unlink(meta['name'])
+                    removed += 1 + _prune(meta)
+                    if not meta['retired']:
+                        os.remove(meta_file)
+                        continue
+                    meta['expire'] = 0  # 当前段已删除，仅保留旧段的引用记录
+                _write_meta(meta_file, meta)
+        if removed:
+            cls.logger.info(f'清理共享内存段{removed}个[{index_dir}]')
+        return removed
+
+
+atexit.register(SharedMemoryCache.release, True)
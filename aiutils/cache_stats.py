@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+@file: cache_stats.py
+缓存统计
+
+* 按被装饰函数记录：命中、未命中、淘汰次数，当前缓存数量及字节数，执行耗时及读取耗时的分布
+* AIUTILS_CACHE_STATS.to_frame() 查询为DataFrame；start_export() 定期输出到logbook
+* 用于找出命中率低、读取比执行还慢等`不划算`的缓存
+"""
+import bisect
+import threading
+
+from logbook import Logger
+
+from aiutils.singleton import SingletonTypeThreadSafe
+
+# 耗时分布的区间上限(秒)：10us ~ 100s 每个数量级分为1 2.5 5三档，最后一档为无穷大
+_LATENCY_BOUNDS = tuple(
+    round(b * 10 ** e, 6) for e in range(-5, 2) for b in (1, 2.5, 5)
+) + (100.0, float('inf'))
+
+
+class LatencyHistogram(object):
+    """ 耗时分布：按_LATENCY_BOUNDS分档计数 """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(_LATENCY_BOUNDS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(_LATENCY_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else float('nan')
+
+    def quantile(self, q):
+        """ 分位数：返回所在档的上限，为近似值 """
+        if not self.count:
+            return float('nan')
+        target, acc = q * self.count, 0
+        for bound, n in zip(_LATENCY_BOUNDS, self.counts):
+            acc += n
+            if acc >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class FuncStats(object):
+    """
+    单个被装饰函数的统计
+    * entries nbytes：当前缓存的数量及字节数；无法计算字节数的缓存(例如lru_cache)为None
+    * compute：未命中时执行原函数的耗时；load：命中时读取缓存的耗时
+    * refreshes refresh_errors：后台刷新(stale-while-revalidate)的成功及失败次数
+    """
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.entries = 0
+        self.nbytes = None
+        self.compute = LatencyHistogram()
+        self.load = LatencyHistogram()
+
+    def hit(self, load_seconds=None):
+        with self._lock:
+            self.hits += 1
+            if load_seconds is not None:
+                self.load.observe(load_seconds)
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def computed(self, seconds):
+        """ 执行原函数的耗时；并发未命中合并执行时，只有执行者记录 """
+        with self._lock:
+            self.compute.observe(seconds)
+
+    def refreshed(self, ok=True):
+        with self._lock:
+            if ok:
+                self.refreshes += 1
+            else:
+                self.refresh_errors += 1
+
+    def change(self, entries=0, nbytes=None, evictions=0):
+        """ 缓存数量及字节数的增量；evictions为淘汰的数量 """
+        with self._lock:
+            self.entries += entries
+            if nbytes is not None:
+                self.nbytes = (self.nbytes or 0) + nbytes
+            self.evictions += evictions
+
+    def set_size(self, entries, nbytes=None):
+        with self._lock:
+            self.entries = entries
+            self.nbytes = nbytes
+
+    def reset(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+            self.refreshes = self.refresh_errors = 0
+            self.compute = LatencyHistogram()
+            self.load = LatencyHistogram()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            calls = self.hits + self.misses
+            # 节省的时间：命中次数 * 平均执行耗时 - 命中时读取的总耗时
+            saved = self.hits * self.compute.mean - self.load.total if self.compute.count else float('nan')
+            return {
+                'name': self.name,
+                'kind': self.kind,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / calls if calls else float('nan'),
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'entries': self.entries,
+                'nbytes': self.nbytes,
+                'compute_mean': self.compute.mean,
+                'compute_p50': self.compute.quantile(0.5),
+                'compute_p99': self.compute.quantile(0.99),
+                'load_mean': self.load.mean,
+                'load_p50': self.load.quantile(0.5),
+                'load_p99': self.load.quantile(0.99),
+                'saved_second': saved,
+            }
+
+
+class _CacheStats(metaclass=SingletonTypeThreadSafe):
+    """ 全部被装饰函数的统计，按 (名称, 缓存类型) 登记 """
+
+    def __init__(self):
+        self.logger = Logger('CacheStats')
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._export_stop = None
+
+    def get(self, name, kind) -> FuncStats:
+        stats = self._stats.get((name, kind))
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault((name, kind), FuncStats(name, kind))
+        return stats
+
+    def reset(self):
+        """ 计数清零；当前缓存数量及字节数保留 """
+        for stats in list(self._stats.values()):
+            stats.reset()
+
+    def to_frame(self):
+        """ 全部统计，每个被装饰函数一行 """
+        import pandas as pd
+        rows = [stats.to_dict() for stats in list(self._stats.values())]
+        df = pd.DataFrame(rows, columns=list(FuncStats('', '').to_dict().keys()))
+        return df.set_index(['kind', 'name']).sort_index()
+
+    def log(self):
+        """ 输出到logbook，每个被装饰函数一行 """
+        for stats in list(self._stats.values()):
+            d = stats.to_dict()
+            self.logger.info(
+                f"[{d['kind']}][{d['name']}] 命中{d['hits']} 未命中{d['misses']} 淘汰{d['evictions']} "
+                f"刷新{d['refreshes']} 刷新失败{d['refresh_errors']} "
+                f"数量{d['entries']} 字节{d['nbytes']} 执行均值{d['compute_mean']:.6f}s "
+                f"读取均值{d['load_mean']:.6f}s 节省{d['saved_second']:.3f}s")
+
+    def start_export(self, interval=600):
+        """ 后台线程每interval秒输出一次到logbook """
+        self.stop_export()
+        stop = self._export_stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.log()
+                except Exception as e:
+                    self.logger.warn(f'输出缓存统计异常 {type(e)}:{e}')
+
+        threading.Thread(target=run, name='CacheStatsExport', daemon=True).start()
+
+    def stop_export(self):
+        if self._export_stop is not None:
+            self._export_stop.set()
+            self._export_stop = None
+
+
+AIUTILS_CACHE_STATS = _CacheStats()
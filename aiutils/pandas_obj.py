@@ -7,6 +7,7 @@ pandas相关的处理函数
 """
 
 import datetime
+import numpy as np
 import pandas as pd
 
 from typing import Iterable
@@ -64,6 +65,87 @@ _DT_FORMAT_S = '%Y-%m-%d %H:%M:%S'
 _DT_FORMAT_D = '%Y-%m-%d'
 
 
+def _df_dt_columns(df: pd.DataFrame, dt_columns: list = None) -> list:
+    """ 传入的dt_columns 加上df自身的时间类型列 """
+    if not dt_columns:
+        dt_columns = []
+    elif isinstance(dt_columns, Iterable):
+        dt_columns = [x for x in dt_columns]
+
+    for x in df.columns:  # 加上df自身的dt属性列
+        if df_col_dt_like(df, x):
+            dt_columns.append(x)
+    return list(set(dt_columns) & set(df.columns))
+
+
+# numpy.datetime_as_string 的精度单位，可直接得到的时间格式(将'T'替换为空格)
+_DT_FORMAT_UNIT = {_DT_FORMAT_F: 'us', _DT_FORMAT_S: 's', _DT_FORMAT_D: 'D'}
+
+
+def _series_dt_str(se: pd.Series, dt_format: str) -> np.ndarray:
+    """ 时间列转str，返回object数组；空值为None """
+    mask = se.isna().to_numpy()
+    if hasattr(se, 'dt') and pd.api.types.is_datetime64_any_dtype(se.dtype):
+        if getattr(se.dt, 'tz', None) is not None:
+            se = se.dt.tz_localize(None)  # 与Timestamp.strftime一致，使用当地时间
+        unit = _DT_FORMAT_UNIT.get(dt_format)
+        if unit is not None:
+            values = np.datetime_as_string(se.to_numpy(dtype='datetime64[us]'), unit=unit)
+            if unit != 'D':
+                values = np.char.replace(values, 'T', ' ')
+        else:
+            values = se.dt.strftime(dt_format).to_numpy()
+        values = values.astype(object)
+    else:  # object列中的datetime/date
+        values = np.array([None if m else x.strftime(dt_format) for x, m in zip(se.to_numpy(), mask)], dtype=object)
+    values[mask] = None
+    return values
+
+
+def _series_values(se: pd.Series) -> np.ndarray:
+    """ 非时间列转object数组(python基础类型)；空值(NaN NaT None pd.NA)为None """
+    values = se.to_numpy(dtype=object)
+    if isinstance(se.dtype, np.dtype) and se.dtype.kind in 'biu':  # numpy整数及布尔列没有空值
+        return values
+    mask = pd.isna(values)
+    if mask.any():
+        if se.dtype == object:  # object列的to_numpy可能与原df共用内存
+            values = values.copy()
+        values[mask] = None
+    return values
+
+
+def df_to_columns(df: pd.DataFrame, dt_columns: list = None, dt_format: str = _DT_FORMAT_F):
+    """
+    将 DataFrame 按列转化为python对象的list，便于进行批量插入；与df_to_dict的处理规则相同，按列向量化处理
+    * 时间列按dt_format转为str，默认的三种格式使用numpy.datetime_as_string
+    * 空值替换为None，每列一次掩码
+    :return: (每列一个list, 列名list)
+    """
+    col_name_list = list(df.columns) if df is not None else []
+    if df is None or df.empty or df.shape[0] == 0:
+        return [], col_name_list
+    if dt_format is None or dt_format.strip() == '':
+        dt_format = _DT_FORMAT_F
+    dt_columns = set(_df_dt_columns(df, dt_columns))
+
+    columns = []
+    for i, name in enumerate(col_name_list):
+        se = df.iloc[:, i]
+        values = _series_dt_str(se, dt_format) if name in dt_columns else _series_values(se)
+        columns.append(values.tolist())
+    return columns, col_name_list
+
+
+def df_to_records(df: pd.DataFrame, dt_columns: list = None, dt_format: str = _DT_FORMAT_F):
+    """
+    将 DataFrame 按行转化为tuple，可直接用于DBAPI的executemany；处理规则同df_to_dict
+    :return: (每行一个tuple, 列名list)
+    """
+    columns, col_name_list = df_to_columns(df, dt_columns, dt_format)
+    return list(zip(*columns)), col_name_list
+
+
 def df_to_dict(df: pd.DataFrame, dt_columns: list = None, dt_format: str = _DT_FORMAT_F):
     """
     将 DataFrame 数据按records转化，便于进行批量插入
@@ -76,33 +158,12 @@ def df_to_dict(df: pd.DataFrame, dt_columns: list = None, dt_format: str = _DT_F
 
     * 空值，必须替换为None-->原因：返回的df_dic_list用于sql拼接参数时，其它的null类型不一定能准确识别
 
+    * 按列向量化处理后再组装为dict，参考df_to_columns；只需要按位置的参数时，使用df_to_records更快
+
     """
     if df is None or df.empty or df.shape[0] == 0:
         return []
 
-    # 补全dt_format
-    if dt_format is None or dt_format.strip() == '':
-        dt_format = _DT_FORMAT_F
-
-    # 记录dt_columns
-    if not dt_columns:
-        dt_columns = []
-    elif isinstance(dt_columns, Iterable):
-        dt_columns = [x for x in dt_columns]
-
-    for x in df.columns:  # 加上df自身的dt属性列
-        if df_col_dt_like(df, x):
-            dt_columns.append(x)
-    dt_columns = list(set(dt_columns) & set(df.columns))
-
-    # 空值替换会将dtype改为object，所以放在dtype记录之后再执行
-    df = df.astype('object').where(pd.notnull(df), None)
-    _null = df.isnull()
-    if dt_columns:
-        for field in dt_columns:
-            df[field] = df[field].apply(lambda x: x.strftime(dt_format) if x else None)
-            # df[field] = df[field].dt.strftime(dt_format)  # fix-->前面NaT转None，此处再strftime又会变成字符串的NaT
-    df = df.astype('object').where(~_null, None)  # 所以使用_null记录位置，替换回来为None
-    df_dic_list = df.to_dict('records')
-    col_name_list = list(df.columns)
+    columns, col_name_list = df_to_columns(df, dt_columns, dt_format)
+    df_dic_list = [dict(zip(col_name_list, row)) for row in zip(*columns)]
     return df_dic_list, col_name_list
@@ -1,27 +1,95 @@
 # -*- coding: utf-8 -*-
+import bisect
 import hashlib
+import os
+import queue
+import random
 import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import accumulate, chain
 from typing import List, Tuple
+import numpy as np
 import pandas as pd
 import sqlalchemy
-from sqlalchemy import Table, MetaData, NVARCHAR, Integer, Float, DateTime, text, inspect
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import NVARCHAR, Integer, Float, DateTime, text, inspect
+from sqlalchemy.exc import DataError, IntegrityError
 from logbook import Logger
 
-from .pandas_obj import df_col_dt_like, df_to_dict
+from .cache import invalidate
+from .pandas_obj import df_col_dt_like, df_to_dict, df_to_records
 from .list_obj import split_iter
 from .sql_session import with_db_session, get_db_session
 
 
+class _SchemaCache(object):
+    """
+    表格结构信息的缓存：是否存在、字段、主键，按 (engine url, schema, 表名) 保存
+    * 每次插入都会查询表格是否存在及字段，小批量插入很多时，这部分查询与插入数据的查询一样多
+    * 本模块执行的DDL(建表、增加列、去重重建)会使对应的表失效；其它程序修改表结构时，ttl秒后重新查询
+    * 插入失败时使对应的表失效；表格不存在(1146)时df_insert_existed重新查询后重试一次，df_insert重新建表
+    * 只缓存表格存在、非空的字段及主键，不存在的表每次都查询(可能已由其它程序创建)
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {}  # (url, schema, 表名): {信息名称: (值, 查询时间)}
+
+    def fetch(self, engine, schema, table_name, field, load, keep=None):
+        """ 返回缓存的信息；没有或已超过ttl时执行load()查询，keep(值)为False时不缓存 """
+        key = (str(engine.url), schema, table_name)
+        entry = self._data.get(key)
+        cached = entry.get(field) if entry else None
+        now = time.time()
+        if cached is not None and now - cached[1] < self.ttl:
+            return cached[0]
+        value = load()
+        if keep is None or keep(value):
+            with self._lock:
+                self._data.setdefault(key, {})[field] = (value, now)
+        return value
+
+    def invalidate(self, engine=None, table_name=None):
+        """ 使表格(全部schema)的缓存失效；engine为None时为全部engine，table_name为None时为engine的全部表 """
+        url = str(engine.url) if engine is not None else None
+        with self._lock:
+            for key in list(self._data):
+                if (url is None or key[0] == url) and (table_name is None or key[2] == table_name):
+                    del self._data[key]
+
+
+AIUTILS_SCHEMA_CACHE = _SchemaCache()
+
+
 def repair_has_table(engine, table_name: str) -> bool:
-    """ has_table判断，兼容sqlalchemy不同版本 """
-    v = str(sqlalchemy.__version__)
-    if v >= '2.0':
-        return inspect(engine).has_table(table_name)  # sqlalchemy版本2.0以上
-    elif v <= '2.0':
-        return engine.has_table(table_name)
-    else:
-        raise ValueError(f'sqlalchemy版本无法判断 got {v}')
+    """ has_table判断，兼容sqlalchemy不同版本；表格存在的结果缓存在AIUTILS_SCHEMA_CACHE """
+
+    def load():
+        v = str(sqlalchemy.__version__)
+        if v >= '2.0':
+            return inspect(engine).has_table(table_name)  # sqlalchemy版本2.0以上
+        elif v <= '2.0':
+            return engine.has_table(table_name)
+        else:
+            raise ValueError(f'sqlalchemy版本无法判断 got {v}')
+
+    return AIUTILS_SCHEMA_CACHE.fetch(engine, engine.url.database, table_name, 'exists', load, keep=bool)
+
+
+def bump_table_version(engine, table_name: str, cache_dirs=()):
+    """
+    使依赖该表的缓存结果失效：标签为 table_name 及 (库名, table_name)，参考 aiutils.cache.invalidate
+    * 其它进程的PickleCache：标签文件写入cache_dirs，以及aiutils.cache.register_tag_dirs或环境变量AIUTILS_TAG_DIRS登记的目录；
+      入库进程通常没有导入读取数据的被装饰函数，需要通过以上方式指定
+    """
+    database = engine.url.database
+    tags = [table_name, (database, table_name)] if database else [table_name]
+    invalidate(*tags, cache_dirs=cache_dirs)
 
 
 def df_types_sql(df: pd.DataFrame):
@@ -38,38 +106,9 @@ def df_types_sql(df: pd.DataFrame):
     return dtypedict
 
 
-def df_insert(df: pd.DataFrame, dt_columns: list, dt_format: str,
-              table_name: str, engine, ignore_none=True, chunksize=1024 * 128, add_col=False,
-              dtype: dict = {}, primary_keys: list = None, schema=None
-              ):
-    """
-    将 DataFrame 数据批量插入数据库，处理方式 ON DUPLICATE KEY UPDATE
-    :param df:
-    :param dt_columns: 最终用于dt_to_dict，含义参考该函数：
-    :param dt_format: 最终用于dt_to_dict，含义参考该函数；
-    :param table_name:
-    :param engine:
-    :param ignore_none: 表存在时：为 None 或 NaN 字段不更新
-    :param chunksize:
-    :param chunksize:
-
-    :param dtype: 创建表格才用到：数据类型的映射；可以为空，会通过df_types_sql计算默认结果；
-    :param primary_keys: 创建表格才用到：设置主键；可以为None，会创建无主键的表格；
-    :param schema: 创建表格并设置主键才用到：通常为数据库的名称；此时不能为空
-    :return:
-    """
+def _create_table(df: pd.DataFrame, table_name: str, engine, dtype: dict, primary_keys: list, schema, chunksize):
+    """ 按df的列创建表格及主键，不插入数据；参数含义参考df_insert """
     logger = Logger(sys._getframe().f_code.co_name)
-    if primary_keys:
-        df = df.dropna(subset=primary_keys)
-    if df.empty:
-        logger.warn(f'数据去除主键空值后长度为零，不做存储！')
-        return
-
-    has_table = repair_has_table(engine, table_name)
-    if has_table:
-        insert_count = df_insert_existed(df, dt_columns, dt_format, table_name, engine, ignore_none, chunksize, add_col)
-        return insert_count
-
     # 升级主键存储类型
     dtype = {k: v for k, v in dtype.items() if v}  # 剔除v为None的无效类型
     if primary_keys:
@@ -118,8 +157,56 @@ def df_insert(df: pd.DataFrame, dt_columns: list, dt_format: str,
     else:
         logger.info('创建表格 %s 没有主键 %s 插入数据%s ' % (table_name, primary_keys, temp.shape))
 
+    AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
+
+
+def df_insert(df: pd.DataFrame, dt_columns: list, dt_format: str,
+              table_name: str, engine, ignore_none=True, chunksize=1024 * 128, add_col=False,
+              dtype: dict = {}, primary_keys: list = None, schema=None, bump_version=False, method='to_sql',
+              workers=1, report=False):
+    """
+    将 DataFrame 数据批量插入数据库，处理方式 ON DUPLICATE KEY UPDATE
+    :param df:
+    :param dt_columns: 最终用于dt_to_dict，含义参考该函数：
+    :param dt_format: 最终用于dt_to_dict，含义参考该函数；
+    :param table_name:
+    :param engine:
+    :param ignore_none: 表存在时：为 None 或 NaN 字段不更新
+    :param chunksize:
+    :param chunksize:
+
+    :param dtype: 创建表格才用到：数据类型的映射；可以为空，会通过df_types_sql计算默认结果；
+    :param primary_keys: 创建表格才用到：设置主键；可以为None，会创建无主键的表格；
+    :param schema: 创建表格并设置主键才用到：通常为数据库的名称；此时不能为空
+    :param bump_version: 插入后使依赖该表的缓存失效，参考 bump_table_version
+    :param method: 插入方式，参考 df_insert_existed
+    :param workers: 并行插入的线程数，参考 df_insert_existed
+    :param report: 是否返回InsertReport，参考 df_insert_existed
+    :return:
+    """
+    logger = Logger(sys._getframe().f_code.co_name)
+    if primary_keys:
+        df = df.dropna(subset=primary_keys)
+    if df.empty:
+        logger.warn(f'数据去除主键空值后长度为零，不做存储！')
+        return
+
+    has_table = repair_has_table(engine, table_name)
+    if has_table:
+        try:
+            return df_insert_existed(df, dt_columns, dt_format, table_name, engine, ignore_none, chunksize, add_col,
+                                     bump_version, method, workers, report)
+        except Exception as e:
+            # 失败时df_insert_existed已使表格结构缓存失效；表格已被其它程序删除时重新创建
+            if repair_has_table(engine, table_name):
+                raise
+            logger.warn(f'{table_name} 已不存在，重新创建 {type(e)}:{e}')
+
+    _create_table(df, table_name, engine, dtype, primary_keys, schema, chunksize)
+
     # 插入数据
-    insert_count = df_insert_existed(df, dt_columns, dt_format, table_name, engine, ignore_none, chunksize, add_col)
+    insert_count = df_insert_existed(df, dt_columns, dt_format, table_name, engine, ignore_none, chunksize, add_col,
+                                     bump_version, method, workers, report)
     return insert_count
 
 
@@ -171,22 +258,107 @@ def _insert_b(df_dic_list, col_name_list,
     return rslt.rowcount
 
 
+# df_insert_existed(report=True)的结果：行数、重试行数、失败行数、错误 [(分区, 块序号, 异常)]
+InsertReport = namedtuple('InsertReport', ['rows', 'retried', 'failed', 'errors'])
+
+
+# 分块写入(_write_chunks)：首次的块大小、失败时对半拆分的下限、可重试异常的重试次数及退避秒数
+_CHUNK_FIRST = 5000
+_CHUNK_FLOOR = 200
+_RETRY_TIMES = 5
+_RETRY_BASE_SECOND = 0.5
+_RETRY_MAX_SECOND = 30
+# 可重试的MySQL错误码：1205锁等待超时 1213死锁 2006 2013 2055连接断开
+_TRANSIENT_ERRORS = (1205, 1213, 2006, 2013, 2055)
+# 个别行数据导致的MySQL错误码，拆分后可写入其它行：1048不能为空 1062主键重复 1264超出范围 1265截断
+# 1292 1366值不正确 1406过长 1452外键
+_ROW_ERRORS = (1048, 1062, 1264, 1265, 1292, 1366, 1406, 1452)
+_NO_TABLE_ERROR = 1146  # 表格不存在
+
+
+def _error_code(e: Exception):
+    """ MySQL错误码；sqlalchemy.exc.DBAPIError取其包装的DBAPI异常，没有时为None """
+    orig = getattr(e, 'orig', e)
+    return orig.args[0] if getattr(orig, 'args', None) else None
+
+
+def _is_transient(e: Exception) -> bool:
+    """ 锁等待超时、死锁、连接断开等可重试的异常 """
+    if getattr(e, 'connection_invalidated', False) or isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    return _error_code(e) in _TRANSIENT_ERRORS
+
+
+def _is_row_error(e: Exception) -> bool:
+    """ 个别行的数据错误(主键重复、值超出范围或过长等)；表格不存在、没有权限、配置错误等不是 """
+    if isinstance(e, (IntegrityError, DataError)):
+        return True
+    if type(getattr(e, 'orig', e)).__name__ in ('IntegrityError', 'DataError'):  # DBAPI的异常类型，例如pymysql.err.DataError
+        return True
+    return _error_code(e) in _ROW_ERRORS
+
+
+def _write_chunks(write, records, first=_CHUNK_FIRST, floor=_CHUNK_FLOOR, retry_times=_RETRY_TIMES) -> InsertReport:
+    """
+    分块写入，每块单独提交
+    * 可重试的异常(参考_is_transient)：按指数退避加随机抖动重试该块
+    * 行数据错误(参考_is_row_error)：只对失败的块对半拆分后重写，已写入的块不再重复；不超过floor的块仍失败时记为失败并继续
+    * 其它异常(表格不存在、没有权限、local_infile未开启等)：拆分也无法写入，直接抛出
+    :param write: write(records的一段) 写入并提交，返回写入数量
+    :return: InsertReport，errors为 [(开始行, 结束行, 异常)]
+    """
+    rows, retried, failed, errors = 0, 0, 0, []
+    pending = [(i, min(i + first, len(records))) for i in range(0, len(records), first)]
+    pending.reverse()
+    while pending:
+        start, end = pending.pop()
+        attempt = 0
+        while True:
+            try:
+                rows += write(records[start:end])
+                break
+            except Exception as e:
+                if _is_transient(e) and attempt < retry_times:
+                    time.sleep(random.uniform(0, min(_RETRY_MAX_SECOND, _RETRY_BASE_SECOND * 2 ** attempt)))
+                    attempt += 1
+                    retried += end - start
+                    continue
+                if not _is_row_error(e):
+                    raise
+                if end - start > floor:
+                    middle = (start + end) // 2
+                    pending.extend([(middle, end), (start, middle)])
+                    retried += end - start
+                else:
+                    failed += end - start
+                    errors.append((start, end, e))
+                break
+    return InsertReport(rows, retried, failed, errors)
+
+
+def _insert_chunked(insert_chunk, records, col_name_list,
+                    engine, table_name, ignore_none, first=_CHUNK_FIRST) -> InsertReport:
+    """ 用insert_chunk分块写入，失败时只重写失败的块，参考_write_chunks；有失败时按调用的插入函数记录日志 """
+    logger = Logger(sys._getframe(1).f_code.co_name)
+
+    def write(chunk):
+        return insert_chunk(chunk, col_name_list, engine, table_name, ignore_none)
+
+    result = _write_chunks(write, records, first=max(first, 1))
+    if result.failed:
+        logger.warn(f'{table_name} 写入{result.rows}行 重试{result.retried}行 失败{result.failed}行 '
+                    f'{type(result.errors[-1][2])}:{result.errors[-1][2]}')
+    return result
+
+
 def _insert_c(df_dic_list, col_name_list,
-              engine, table_name, ignore_none):
-    for chunk in [5000, 1000, 200]:
-        try:
-            temp = _insert_c_chunk(df_dic_list, col_name_list,
-                                   engine, table_name, ignore_none, chunk)
-        except Exception as e:
-            status, result = e, None
-        else:
-            status, result = None, temp
-            break
-    # 判断结果
-    if isinstance(status, Exception):
-        raise status
-    else:
-        return result
+              engine, table_name, ignore_none) -> InsertReport:
+    """ pd.to_sql拼接 on_duplicate；分块写入，失败时只重写失败的块，参考_write_chunks """
+
+    def insert_chunk(chunk, *args):
+        return _insert_c_chunk(chunk, *args, len(chunk))
+
+    return _insert_chunked(insert_chunk, df_dic_list, col_name_list, engine, table_name, ignore_none)
 
 
 def _insert_c_chunk(df_dic_list, col_name_list,
@@ -226,78 +398,482 @@ def _insert_c_chunk(df_dic_list, col_name_list,
     return len(df_dic_list)
 
 
+# LOAD DATA 默认的转义规则：FIELDS TERMINATED BY '\t' ESCAPED BY '\\' LINES TERMINATED BY '\n'，空值为\N
+_TSV_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+_TSV_NULL = '\\N'
+# 客户端或服务端未开启local_infile时的错误码
+_LOCAL_INFILE_ERRORS = (1148, 2068, 3948)
+
+
+def _tsv_value(x) -> str:
+    if x is None:
+        return _TSV_NULL
+    if isinstance(x, str):
+        return x.translate(_TSV_ESCAPE)
+    if isinstance(x, bool):
+        return '1' if x else '0'
+    if isinstance(x, bytes):
+        return x.decode('utf-8').translate(_TSV_ESCAPE)
+    return str(x).translate(_TSV_ESCAPE)
+
+
+def _write_tsv(file, records):
+    """ 按行写入LOAD DATA可读取的TSV，records为df_to_records的结果 """
+    with open(file, 'w', encoding='utf-8', newline='\n') as f:
+        for row in records:
+            f.write('\t'.join([_tsv_value(x) for x in row]))
+            f.write('\n')
+
+
+def _upsert_directive(col_name_list, ignore_none, table_name=None) -> str:
+    """ ON DUPLICATE KEY UPDATE 的赋值部分；table_name不为None时原表字段加上表名(INSERT ... SELECT需要) """
+    prefix = f'`{table_name}`.' if table_name else ''
+    if ignore_none:
+        return ','.join(f'{prefix}`{x}`=IFNULL(VALUES(`{x}`), {prefix}`{x}`)' for x in col_name_list)
+    return ','.join(f'{prefix}`{x}`=VALUES(`{x}`)' for x in col_name_list)
+
+
+def _insert_load_data(records, col_name_list,
+                      engine, table_name, ignore_none) -> InsertReport:
+    """
+    LOAD DATA LOCAL INFILE 的方式，参考_insert_load_data_chunk
+    * 整块写入；失败时按_write_chunks重试或对半拆分，只重写失败的部分
+    """
+    try:
+        return _insert_chunked(_insert_load_data_chunk, records, col_name_list, engine, table_name, ignore_none,
+                               first=len(records))
+    except Exception as e:
+        if _error_code(e) in _LOCAL_INFILE_ERRORS:
+            Logger(sys._getframe().f_code.co_name).error(
+                f'{table_name} LOAD DATA LOCAL INFILE 未开启，需要客户端及服务端设置local_infile')
+        raise
+
+
+def _insert_load_data_chunk(records, col_name_list,
+                            engine, table_name, ignore_none):
+    """
+    LOAD DATA LOCAL INFILE 的方式
+    * 写入临时的TSV文件 -> LOAD DATA到会话临时表(CREATE TEMPORARY TABLE LIKE 原表) -> INSERT ... SELECT ... ON DUPLICATE KEY UPDATE
+    * 需要客户端及服务端都开启local_infile，例如 create_engine(url, connect_args={'local_infile': True})，服务端 local_infile=ON
+    * 临时表有与原表相同的主键，同一批数据中主键重复时保留最后一行(LOAD DATA ... REPLACE)
+    * 使用DBAPI连接执行，不经过sqlalchemy参数化，表名字段名含有 ): 等字符也不会出错
+    """
+    stage = '_load_' + hashlib.md5(table_name.encode('utf-8')).hexdigest()[:16]
+    col_names = "`" + "`,`".join(col_name_list) + "`"
+    fd, file = tempfile.mkstemp(prefix='aiutils_load_', suffix='.tsv')
+    os.close(fd)
+    conn = engine.raw_connection()
+    try:
+        _write_tsv(file, records)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS `{stage}`")
+            cursor.execute(f"CREATE TEMPORARY TABLE `{stage}` LIKE `{table_name}`")
+            load_sql = (f"LOAD DATA LOCAL INFILE '{file.replace(os.sep, '/')}' REPLACE INTO TABLE `{stage}` "
+                        f"CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                        f"LINES TERMINATED BY '\\n' ({col_names})")
+            cursor.execute(load_sql)
+            cursor.execute(f"INSERT INTO `{table_name}` ({col_names}) SELECT {col_names} FROM `{stage}` "
+                           f"ON DUPLICATE KEY UPDATE {_upsert_directive(col_name_list, ignore_none, table_name)}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS `{stage}`")
+            except Exception:
+                pass
+            cursor.close()
+    finally:
+        conn.close()  # 归还连接池
+        os.remove(file)
+    return len(records)
+
+
+_DEFAULT_MAX_PACKET = 4 * 1024 * 1024  # 查询不到max_allowed_packet时使用，MySQL 5.7的默认值
+_MAX_BATCH_ROWS = 8192  # 单条语句的行数上限，行数太多时服务端解析变慢
+_server_max_packet = {}  # engine url: max_allowed_packet
+_server_max_packet_lock = threading.Lock()
+
+
+def server_max_packet(engine) -> int:
+    """ 服务端的max_allowed_packet(字节)，每个engine只查询一次 """
+    key = str(engine.url)
+    packet = _server_max_packet.get(key)
+    if packet is None:
+        with _server_max_packet_lock:
+            packet = _server_max_packet.get(key)
+            if packet is None:
+                try:
+                    with engine.connect() as conn:
+                        packet = int(conn.execute(text('SELECT @@max_allowed_packet')).scalar())
+                except Exception as e:
+                    Logger('server_max_packet').warn(f'查询max_allowed_packet失败，使用{_DEFAULT_MAX_PACKET} {type(e)}:{e}')
+                    packet = _DEFAULT_MAX_PACKET
+                _server_max_packet[key] = packet
+    return packet
+
+
+@lru_cache(maxsize=64)
+def _multi_values_sql(table_name, col_names: tuple, ignore_none, batch_rows) -> str:
+    """ batch_rows行的 INSERT ... VALUES (%s,...),(%s,...) ON DUPLICATE KEY UPDATE 语句；名称中的%需要转义 """
+    table_name = table_name.replace('%', '%%')
+    col_names = [x.replace('%', '%%') for x in col_names]
+    row = '(' + ','.join(['%s'] * len(col_names)) + ')'
+    return "INSERT INTO `{table_name}` ({col_names}) VALUES {values} ON DUPLICATE KEY UPDATE {update}".format(
+        table_name=table_name,
+        col_names="`" + "`,`".join(col_names) + "`",
+        values=','.join([row] * batch_rows),
+        update=_upsert_directive(col_names, ignore_none),
+    )
+
+
+def _value_bytes(x) -> int:
+    """ 值在语句中的UTF-8字节数，含引号及逗号；转义字符另计在max_packet一半的余量中 """
+    if x is None:
+        return 5  # NULL,
+    if isinstance(x, str):
+        return (len(x) if x.isascii() else len(x.encode('utf-8'))) + 3
+    if isinstance(x, bytes):
+        return 2 * len(x) + 10  # _binary'...'，转义后最多两倍
+    return len(str(x)) + 3
+
+
+def _batches(records, max_packet):
+    """
+    按每行的UTF-8字节数累计分批，单条语句不超过max_packet的一半，且不超过_MAX_BATCH_ROWS行
+    * 每批的行数取不超过上限的2的幂次，剩余的行同样按2的幂次分批；每张表的语句模板最多 log2(_MAX_BATCH_ROWS)+1 个
+    """
+    offsets = list(accumulate((sum(map(_value_bytes, row)) for row in records), initial=0))
+    limit, start = max_packet // 2, 0
+    while start < len(records):
+        end = bisect.bisect_right(offsets, offsets[start] + limit, lo=start + 1) - 1
+        rows = min(max(end - start, 1), _MAX_BATCH_ROWS)
+        rows = 1 << (rows.bit_length() - 1)
+        yield records[start:start + rows]
+        start += rows
+
+
+def _insert_multi_values(records, col_name_list,
+                         engine, table_name, ignore_none) -> InsertReport:
+    """
+    多行VALUES的方式，参考_insert_multi_values_chunk
+    * 整块写入；失败时按_write_chunks重试或对半拆分，只重写失败的部分
+    """
+    return _insert_chunked(_insert_multi_values_chunk, records, col_name_list, engine, table_name, ignore_none,
+                           first=len(records))
+
+
+def _insert_multi_values_chunk(records, col_name_list,
+                               engine, table_name, ignore_none):
+    """
+    多行VALUES的方式
+    * 每条语句包含多行 VALUES (...),(...)，使用位置参数；按每行的UTF-8字节数及服务端max_allowed_packet分批，参考_batches
+    * 语句模板按 (表名, 列名, ignore_none, 行数) 缓存，行数均为2的幂次
+    * 使用DBAPI连接执行，全部语句执行完成后提交
+    """
+    max_packet = server_max_packet(engine)
+    col_names = tuple(col_name_list)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        try:
+            for batch in _batches(records, max_packet):
+                sql_str = _multi_values_sql(table_name, col_names, ignore_none, len(batch))
+                cursor.execute(sql_str, list(chain.from_iterable(batch)))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    finally:
+        conn.close()  # 归还连接池
+    return len(records)
+
+
+def _partition_by_keys(df: pd.DataFrame, keys: list, workers: int) -> list:
+    """
+    按主键排序后切分为最多workers个连续的主键区间，同一主键在同一分区；keys为空或不全在df中时按行号连续分区
+    * 各线程写入的主键区间互不交错，间隙锁(gap lock)不会交叉等待；相同主键保持原来的先后顺序
+    """
+    rows = len(df.index)
+    size = max(-(-rows // workers), 1)
+    if keys and set(keys).issubset(df.columns):
+        df = df.sort_values(keys, kind='stable')
+        # 每个主键的第一行；分区边界取每等份之后第一个主键的开始行
+        starts = np.append(np.flatnonzero(df[keys].ne(df[keys].shift()).any(axis=1).to_numpy()), rows)
+        bounds = np.unique(np.concatenate([[0], starts[np.searchsorted(starts, np.arange(size, rows, size))], [rows]]))
+        parts = [df.iloc[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    else:
+        parts = [df.iloc[each, :] for each in split_iter(range(rows), size)]
+    return [x for x in parts if not x.empty]
+
+
+def _as_report(res) -> InsertReport:
+    """ 插入函数的结果：_write_chunks分块写入的为InsertReport，其它为插入数量 """
+    return res if isinstance(res, InsertReport) else InsertReport(res, 0, 0, [])
+
+
+# 插入方式：(记录整理函数, 插入函数)
+_INSERT_METHODS = {
+    'to_sql': (df_to_dict, _insert_c),
+    'load_data': (df_to_records, _insert_load_data),
+    'multi_values': (df_to_records, _insert_multi_values),
+}
+
+
+def _table_add_new_cols(df: pd.DataFrame, table_name: str, engine):
+    """ 表格中没有的df列，按df_types_sql增加 """
+    logger = Logger(sys._getframe().f_code.co_name)
+    raw = {x[0] for x in table_get_columns(table_name, engine, engine.url.database)}
+    tb_add = list(set(df.columns).difference(raw))
+    if tb_add:
+        dtype = df_types_sql(df[tb_add])
+        logger.debug(f'已存在 {table_name} 增加新列{dtype}')
+        for k, v in dtype.items():
+            table_add_col(engine, table_name, k, str(v))
+
+    # df_add = list(raw.difference(set(df.columns)))
+    # if df_add:
+    #     logger.debug(f'已存在{table_name} DataFrame增加新列{df_add}')
+    #     for x in df_add:
+    #         df[x] = None
+
+
 def df_insert_existed(df: pd.DataFrame, dt_columns: list, dt_format: str,
-                      table_name: str, engine, ignore_none=True, chunksize=1024 * 128, add_col=False):
+                      table_name: str, engine, ignore_none=True, chunksize=1024 * 128, add_col=False,
+                      bump_version=False, method='to_sql', workers=1, report=False):
     """
     将 DataFrame 数据批量插入数据库。要求表格已存在
     先split_ilter整个df，再进行df_to_dict略快一点
+    bump_version: 插入后使依赖该表的缓存失效，参考 bump_table_version
+    method: 插入方式
+        'to_sql' pd.to_sql拼接 ON DUPLICATE KEY UPDATE，参考_insert_c
+        'load_data' 每个chunksize写入临时文件，LOAD DATA LOCAL INFILE到临时表后合并，参考_insert_load_data；大批量时快很多
+        'multi_values' 多行VALUES语句，按max_allowed_packet分批，参考_insert_multi_values；不需要local_infile
+    workers: 并行插入的线程数；按主键排序后切分为连续区间，同一主键只由一个线程写入，各线程的主键区间不交错，避免线程之间的死锁。
+        每个线程使用连接池中的一个连接，不应超过engine的pool_size；表格没有主键时按行号分区
+    report: True时返回InsertReport，失败的块记录在errors中并继续插入其它块；False时返回插入数量，出错时抛出异常
     """
     logger = Logger(sys._getframe().f_code.co_name)
+    if method not in _INSERT_METHODS:
+        raise ValueError(f"arg method should in {list(_INSERT_METHODS)} got {method}")
+    to_records, insert_func = _INSERT_METHODS[method]
     has_table = repair_has_table(engine, table_name)
     if not has_table:
         raise RuntimeError('{} not in {}，需先创建或使用函数`df_insert` '.format(table_name, engine))
     # 检查是否增加新列
     if add_col:
-        table_model = Table(table_name, MetaData(bind=engine), autoload=True)
-        raw = set(table_model.columns.keys())
-        tb_add = list(set(df.columns).difference(raw))
-        if tb_add:
-            dtype = df_types_sql(df[tb_add])
-            logger.debug(f'已存在 {table_name} 增加新列{dtype}')
-            for k, v in dtype.items():
-                table_add_col(engine, table_name, k, str(v))
-
-        # df_add = list(raw.difference(set(df.columns)))
-        # if df_add:
-        #     logger.debug(f'已存在{table_name} DataFrame增加新列{df_add}')
-        #     for x in df_add:
-        #         df[x] = None
+        _table_add_new_cols(df, table_name, engine)
 
-    # 插入数据
-    insert_count = 0
-    for each in split_iter(range(len(df.index)), chunksize):
-        each_df = df.iloc[each, :]
-        df_dic_list, col_name_list = df_to_dict(each_df, dt_columns, dt_format)
-        if not df_dic_list:
-            continue
-        # sqlalchemy表名字段名含有特殊字符):的问题 https://www.cnblogs.com/i-love-python/p/11593501.html -->使用pd.to_sql一般能解决
-        res = _insert_c(df_dic_list, col_name_list, engine, table_name, ignore_none)  # fixme 使用不同的插入方法
-        insert_count += res
-
-    logger.info(f'任务表格 {table_name} 任务操作{insert_count} 任务数据{df.shape}')
-    return insert_count
+    def _run(worker, part):
+        """ 按chunksize依次插入一个分区；返回 (行数, 重试行数, 失败行数, 错误) """
+        rows, retried, failed, errors = 0, 0, 0, []
+        for num, each in enumerate(split_iter(range(len(part.index)), chunksize)):
+            each_df = part.iloc[each, :]
+            try:
+                df_dic_list, col_name_list = to_records(each_df, dt_columns, dt_format)
+                if not df_dic_list:
+                    continue
+                # sqlalchemy表名字段名含有特殊字符):的问题 https://www.cnblogs.com/i-love-python/p/11593501.html -->使用pd.to_sql一般能解决
+                res = _as_report(insert_func(df_dic_list, col_name_list, engine, table_name, ignore_none))
+                if res.errors and not report:
+                    raise res.errors[0][2]
+                rows, retried, failed = rows + res.rows, retried + res.retried, failed + res.failed
+                errors.extend((worker, num, x[2]) for x in res.errors)
+            except Exception as e:
+                if not report or _error_code(e) == _NO_TABLE_ERROR:  # 表格不存在时其它块也无法写入
+                    raise
+                logger.warn(f'{table_name} 分区{worker} 第{num}块{len(each_df)}行插入失败 {type(e)}:{e}')
+                failed += len(each_df)
+                errors.append((worker, num, e))
+        return rows, retried, failed, errors
+
+    def _run_all():
+        # 插入数据：workers>1时按主键区间分区，每个线程处理一个分区，使用连接池中不同的连接
+        if workers > 1:
+            keys = [x[0] for x in table_get_keys(table_name, engine, engine.url.database)]
+            parts = _partition_by_keys(df, keys, workers)
+        else:
+            parts = [df]
+        if len(parts) > 1:
+            with ThreadPoolExecutor(len(parts), thread_name_prefix='df_insert') as pool:
+                futures = [pool.submit(_run, i, x) for i, x in enumerate(parts)]
+                wait(futures)
+            return [x.result() for x in futures]  # report=False时抛出第一个分区的异常
+        return [_run(0, x) for x in parts]
+
+    # 失败时表格结构缓存失效(表格可能已被其它程序删除或修改)；表格不存在时重新查询，仍存在则重试一次
+    try:
+        results = _run_all()
+    except Exception as e:
+        AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
+        if _error_code(e) != _NO_TABLE_ERROR:
+            raise
+        if not repair_has_table(engine, table_name):
+            raise RuntimeError('{} not in {}，需先创建或使用函数`df_insert` '.format(table_name, engine)) from e
+        logger.warn(f'{table_name} 表格结构已变化，重试一次 {type(e)}:{e}')
+        results = _run_all()
+    insert_count = sum(x[0] for x in results)
+    result = InsertReport(insert_count, sum(x[1] for x in results), sum(x[2] for x in results),
+                          [e for x in results for e in x[3]])
+    if result.failed:
+        AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
+
+    logger.info(f'任务表格 {table_name} 任务操作{insert_count} 任务数据{df.shape}'
+                + (f' 失败{result.failed}' if result.failed else ''))
+    if bump_version and insert_count:
+        bump_table_version(engine, table_name)
+    return result if report else insert_count
+
+
+def df_insert_stream(frames, dt_columns: list, dt_format: str,
+                     table_name: str, engine, ignore_none=True, chunksize=1024 * 128, add_col=False,
+                     dtype: dict = {}, primary_keys: list = None, schema=None, bump_version=False, method='to_sql',
+                     queue_size=2, report=False):
+    """
+    逐个读取DataFrame并插入数据库，用于大量历史数据的回补；不需要全部数据同时在内存中
+    * 表格不存在时，按第一个非空的DataFrame创建表格及主键(参考df_insert)
+    * 后台线程遍历frames并按chunksize整理记录，通过有界队列交给当前线程写入数据库：读取解析与写入同时进行，
+      内存中最多为读取中的DataFrame加上queue_size+2块记录
+    * add_col为True时，出现新列时增加
+    :param frames: DataFrame的可迭代对象，例如按文件逐个读取的生成器
+    :param queue_size: 已整理、等待写入的块数量上限
+    :param report: True时返回InsertReport，errors为 [(第几个DataFrame, 块序号, 异常)]；其它参数参考df_insert
+    """
+    logger = Logger(sys._getframe().f_code.co_name)
+    if method not in _INSERT_METHODS:
+        raise ValueError(f"arg method should in {list(_INSERT_METHODS)} got {method}")
+    to_records, insert_func = _INSERT_METHODS[method]
+
+    frames = iter(frames)
+    first = None
+    for df in frames:
+        if primary_keys:
+            df = df.dropna(subset=primary_keys)
+        if not df.empty:
+            first = df
+            break
+    if first is None:
+        logger.warn(f'数据去除主键空值后长度为零，不做存储！')
+        return
+    if not repair_has_table(engine, table_name):
+        _create_table(first, table_name, engine, dtype, primary_keys, schema, chunksize)
+
+    chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        """ 后台线程：读取DataFrame并整理记录；出现新的列组合时附带前100行，用于增加新列 """
+        seen = set()
+        try:
+            for num, df in enumerate(chain([first], frames)):
+                if primary_keys:
+                    df = df.dropna(subset=primary_keys)
+                for chunk, each in enumerate(split_iter(range(len(df.index)), chunksize)):
+                    each_df = df.iloc[each, :]
+                    records, col_name_list = to_records(each_df, dt_columns, dt_format)
+                    if not records:
+                        continue
+                    columns = frozenset(col_name_list)
+                    sample = each_df.iloc[:100] if columns not in seen else None
+                    seen.add(columns)
+                    if not put((num, chunk, records, col_name_list, sample)):
+                        return
+            put(end)
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, name='df_insert_stream', daemon=True)
+    producer.start()
+    rows, retried, failed, errors, frame_count = 0, 0, 0, [], 0
+    try:
+        while True:
+            item = chunks.get()
+            if item is end:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            num, chunk, records, col_name_list, sample = item
+            frame_count = num + 1
+            try:
+                if add_col and sample is not None:
+                    _table_add_new_cols(sample, table_name, engine)
+                res = _as_report(insert_func(records, col_name_list, engine, table_name, ignore_none))
+                if res.errors and not report:
+                    raise res.errors[0][2]
+            except Exception as e:
+                AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)  # 表格可能已被其它程序删除或修改
+                if not report:
+                    raise
+                logger.warn(f'{table_name} 第{num}个DataFrame 第{chunk}块{len(records)}行插入失败 {type(e)}:{e}')
+                failed += len(records)
+                errors.append((num, chunk, e))
+                continue
+            rows, retried, failed = rows + res.rows, retried + res.retried, failed + res.failed
+            errors.extend((num, chunk, x[2]) for x in res.errors)
+    finally:
+        stop.set()  # 写入出错时通知后台线程停止
+    producer.join()
+
+    logger.info(f'任务表格 {table_name} 任务操作{rows} DataFrame数量{frame_count}'
+                + (f' 失败{failed}' if failed else ''))
+    if bump_version and rows:
+        bump_table_version(engine, table_name)
+    return InsertReport(rows, retried, failed, errors) if report else rows
 
 
 def table_get_keys(table_name, engine, table_schema):
-    """获取table的主键
+    """获取table的主键；结果缓存在AIUTILS_SCHEMA_CACHE，没有主键(或表格不存在)时不缓存
+    :param table_schema: None时为连接的当前数据库(SELECT DATABASE())
     :return: List["Tuple"] like [(主键名称，主键类型)]
     """
     sql_str = """SELECT column_name, column_type
         FROM information_schema.columns
-        WHERE table_schema=:table_schema AND table_name=:table_name and COLUMN_KEY='PRI'"""
-    with with_db_session(engine) as session:
-        table = session.execute(text(sql_str), params={
-            'table_schema': table_schema,
-            'table_name': table_name,
-        })
-        key_list = [(col_name, col_type) for col_name, col_type in table.fetchall()]
-        return key_list
+        WHERE table_schema=COALESCE(:table_schema, DATABASE()) AND table_name=:table_name and COLUMN_KEY='PRI'"""
+
+    def load():
+        with with_db_session(engine) as session:
+            table = session.execute(text(sql_str), params={
+                'table_schema': table_schema,
+                'table_name': table_name,
+            })
+            return [(col_name, col_type) for col_name, col_type in table.fetchall()]
+
+    return list(AIUTILS_SCHEMA_CACHE.fetch(engine, table_schema, table_name, 'keys', load, keep=bool))
 
 
 def table_get_columns(table_name, engine, schema) -> List["Tuple"]:
-    """获取table的字段信息。
+    """获取table的字段信息，按字段顺序；结果缓存在AIUTILS_SCHEMA_CACHE，表格不存在(没有字段)时不缓存
+    :param schema: None时为连接的当前数据库(SELECT DATABASE())
     :return: List["Tuple"] like [(列名称，列类型，是否主键bool)]
     """
     sql_str = """SELECT COLUMN_NAME, COLUMN_TYPE, COLUMN_KEY
         FROM information_schema.columns
-        WHERE table_schema=:table_schema AND table_name=:table_name"""
-    with with_db_session(engine) as session:
-        table = session.execute(text(sql_str), params={
-            'table_schema': schema,
-            'table_name': table_name,
-        })
-        key_list = [(col_name, col_type, col_key == 'PRI') for col_name, col_type, col_key in table.fetchall()]
-        return key_list
+        WHERE table_schema=COALESCE(:table_schema, DATABASE()) AND table_name=:table_name
+        ORDER BY ORDINAL_POSITION"""
+
+    def load():
+        with with_db_session(engine) as session:
+            table = session.execute(text(sql_str), params={
+                'table_schema': schema,
+                'table_name': table_name,
+            })
+            return [(col_name, col_type, col_key == 'PRI') for col_name, col_type, col_key in table.fetchall()]
+
+    return list(AIUTILS_SCHEMA_CACHE.fetch(engine, schema, table_name, 'columns', load, keep=bool))
 
 
 def table_drop_duplicate_keep(table_name, engine, schema, columns: list, keep_by: str = None, keep_m: str = 'min'):
@@ -358,6 +934,7 @@ def table_drop_duplicate_keep(table_name, engine, schema, columns: list, keep_by
                 session.execute(text(del_sql))
             except:
                 pass
+        AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
         return crud
 
 
@@ -390,6 +967,8 @@ def table_drop_duplicate_rows(table_name, engine, schema, columns: list):
         crud = session.execute(text(drop_raw_sql))
         crud = session.execute(text(rename_sql))
         session.commit()
+    AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
+    AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name_copy)
     return crud_
 
 
@@ -404,18 +983,20 @@ def table_add_col(engine, table_name, col_name, col_type_str: str):
     """
     logger = Logger(sys._getframe().f_code.co_name)
 
-    metadata = MetaData(bind=engine)
-    table_model = Table(table_name, metadata, autoload=True)
-    if col_name not in table_model.columns:
+    columns = [x[0] for x in table_get_columns(table_name, engine, engine.url.database)]
+    if not columns:
+        raise RuntimeError('{} not in {}，无法增加列 {}'.format(table_name, engine, col_name))
+    if col_name not in columns:
         # 该语句无法自动更新数据库表结构，因此该方案放弃
         # table_model.append_column(Column(col_name, dtype))
-        after_col_name = table_model.columns.keys()[-1]
+        after_col_name = columns[-1]
         add_col_sql_str = "ALTER TABLE `{0}` ADD COLUMN `{1}` {2} NULL AFTER `{3}`".format(
             table_name, col_name, col_type_str, after_col_name
         )
         with with_db_session(engine) as session:
             session.execute(text(add_col_sql_str))
             session.commit()
+        AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
         logger.info('%s 添加 %s [%s] 列成功' % (table_name, col_name, col_type_str))
 
 
@@ -462,5 +1043,7 @@ def table_drop_duplicate(table_name, engine, primary_key=None):
         sql_str = f"rename table {table_name_bak} to `{table_name}` "
         session.execute(text(sql_str))
         logger.debug('重命名 %s --> %s' % (table_name_bak, table_name))
+    AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name)
+    AIUTILS_SCHEMA_CACHE.invalidate(engine, table_name_bak)
 
     logger.info('完成主键去重 %s' % (table_name))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+@file: bench_cache_key.py
+缓存key生成的耗时对比：旧写法(getcallargs + pickle + md5) 与 aiutils.cache._make_arguments_to_key
+
+运行: python benchmarks/bench_cache_key.py
+"""
+import hashlib
+import inspect
+import pickle
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from aiutils.cache import _make_arguments_to_key
+
+
+def _legacy_make_arguments_to_key(method, *args, **kwargs):
+    """ 1.6.1版本的写法，作为对比基准 """
+    arg_dict = inspect.getcallargs(method, *args, **kwargs)
+    arg_dict.update({'__qualname__': method.__qualname__, '__module__': method.__module__})
+    arg_dict.pop('self', None)
+    arg_dict.pop('cls', None)
+    sorted_arg_dict = sorted(arg_dict.items())
+    return hashlib.md5(pickle.dumps(sorted_arg_dict)).hexdigest()
+
+
+def _code_like(api_code: str, api_exchange_map: dict = {}):
+    pass
+
+
+def _bars_like(order_book_id, start, end, fields=None, frequency='1d'):
+    pass
+
+
+def _factor_like(df, window=20):
+    pass
+
+
+def main(number=20000):
+    frame = pd.DataFrame(np.random.rand(1_000_000, 8), columns=list('abcdefgh'))
+    cases = [
+        ('基础类型参数', _code_like, ('RB2201.SHF',), {}),
+        ('基础类型+list参数', _bars_like, ('RB2201', '2021-01-01', '2021-12-31'), {'fields': ['open', 'close']}),
+        ('1M行DataFrame参数', _factor_like, (frame,), {'window': 20}),
+    ]
+    print(f"{'场景':<20}{'旧写法 us/次':>14}{'新写法 us/次':>14}{'加速':>8}")
+    for name, func, args, kwargs in cases:
+        n = number if 'DataFrame' not in name else 20
+        old = timeit.timeit(lambda: _legacy_make_arguments_to_key(func, *args, **kwargs), number=n) / n * 1e6
+        new = timeit.timeit(lambda: _make_arguments_to_key(func, *args, **kwargs), number=n) / n * 1e6
+        print(f"{name:<20}{old:>14.1f}{new:>14.1f}{old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+@file: bench_df_to_dict.py
+批量插入前记录整理的耗时对比：旧写法(astype object + where + apply strftime + to_dict) 与
+aiutils.pandas_obj 的 df_to_dict / df_to_records / df_to_columns
+
+运行: python benchmarks/bench_df_to_dict.py [行数，默认1000000]
+"""
+import sys
+import time
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from aiutils.pandas_obj import _DT_FORMAT_F, df_col_dt_like, df_to_columns, df_to_dict, df_to_records
+
+
+def _legacy_df_to_dict(df: pd.DataFrame, dt_columns: list = None, dt_format: str = _DT_FORMAT_F):
+    """ 1.6.1版本的写法，作为对比基准 """
+    if df is None or df.empty or df.shape[0] == 0:
+        return []
+    if dt_format is None or dt_format.strip() == '':
+        dt_format = _DT_FORMAT_F
+    if not dt_columns:
+        dt_columns = []
+    elif isinstance(dt_columns, Iterable):
+        dt_columns = [x for x in dt_columns]
+    for x in df.columns:
+        if df_col_dt_like(df, x):
+            dt_columns.append(x)
+    dt_columns = list(set(dt_columns) & set(df.columns))
+    df = df.astype('object').where(pd.notnull(df), None)
+    _null = df.isnull()
+    if dt_columns:
+        for field in dt_columns:
+            df[field] = df[field].apply(lambda x: x.strftime(dt_format) if x else None)
+    df = df.astype('object').where(~_null, None)
+    df_dic_list = df.to_dict('records')
+    col_name_list = list(df.columns)
+    return df_dic_list, col_name_list
+
+
+def _tick_frame(rows):
+    """ 类似tick数据：代码、时间、价格、成交量，部分空值 """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'order_book_id': rng.choice(['000001.XSHE', '600000.XSHG', 'RB2201'], rows),
+        'datetime': pd.date_range('2021-01-04 09:30', periods=rows, freq='500ms'),
+        'trading_date': pd.date_range('2021-01-04', periods=rows, freq='min').normalize(),
+        'last': rng.random(rows) * 100,
+        'volume': rng.integers(0, 10000, rows),
+        'open_interest': rng.random(rows),
+    })
+    df.loc[df.index[::7], 'last'] = np.nan
+    df.loc[df.index[::11], 'datetime'] = pd.NaT
+    return df
+
+
+def main(rows=1_000_000):
+    df = _tick_frame(rows)
+    cases = [
+        ('旧写法 df_to_dict', lambda: _legacy_df_to_dict(df)),
+        ('df_to_dict', lambda: df_to_dict(df)),
+        ('df_to_records', lambda: df_to_records(df)),
+        ('df_to_columns', lambda: df_to_columns(df)),
+    ]
+    base = None
+    print(f'{rows}行 {df.shape[1]}列')
+    print(f"{'方法':<20}{'秒':>10}{'加速':>8}")
+    for name, func in cases:
+        t0 = time.perf_counter()
+        func()
+        cost = time.perf_counter() - t0
+        base = base or cost
+        print(f'{name:<20}{cost:>10.3f}{base / cost:>8.1f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@file: bench_pickle_columnar.py
+PickleCache 不同df_format的读取对比：pickle / feather(Arrow IPC, 内存映射) / parquet
+
+* 每种格式在新的子进程中读取：首次读取记为cold(含pandas/pyarrow的导入耗时)，同一进程再次读取记为warm
+* cold没有清理操作系统的页缓存，需要真正的冷读取时，先手动清理(例如 echo 3 > /proc/sys/vm/drop_caches)
+* RSS为子进程的峰值常驻内存(ru_maxrss)
+
+运行: python benchmarks/bench_pickle_columnar.py [行数，默认10000000]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from aiutils.cache import _PickleSpec, PickleCache
+
+_READER = """
+import resource, sys, time
+from aiutils.cache import _load_cache_file
+t0 = time.perf_counter(); df = _load_cache_file(sys.argv[1]); t1 = time.perf_counter()
+del df
+t2 = time.perf_counter(); df = _load_cache_file(sys.argv[1]); t3 = time.perf_counter()
+print(t1 - t0, t3 - t2, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def make_frame(rows):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'datetime': pd.date_range('2010-01-01', periods=rows, freq='s'),
+        'open': rng.random(rows),
+        'high': rng.random(rows),
+        'low': rng.random(rows),
+        'close': rng.random(rows),
+        'volume': rng.integers(0, 10 ** 6, rows),
+    })
+
+
+def main(rows=10_000_000):
+    df = make_frame(rows)
+    cache_dir = tempfile.mkdtemp()
+    print(f'rows={rows} 内存占用={df.memory_usage(deep=True).sum() / 2 ** 20:.0f}MB')
+    print(f"{'格式':<10}{'写入s':>8}{'文件MB':>8}{'cold s':>8}{'warm s':>8}{'RSS MB':>8}")
+    for df_format in [None, 'feather', 'parquet']:
+        cache_file = os.path.join(cache_dir, str(df_format))
+        spec = _PickleSpec(cache_dir, df_format=df_format)
+        t0 = time.perf_counter()
+        PickleCache._write(cache_file, df, spec, make_frame)
+        write_s = time.perf_counter() - t0
+        out = subprocess.run([sys.executable, '-c', _READER, cache_file], capture_output=True, text=True, check=True)
+        cold, warm, rss_kb = out.stdout.split()
+        print(f"{str(df_format):<10}{write_s:>8.2f}{os.path.getsize(cache_file) / 2 ** 20:>8.0f}"
+              f"{float(cold):>8.2f}{float(warm):>8.2f}{int(rss_kb) / 1024:>8.0f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000)
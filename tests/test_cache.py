@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+@file: test_cache.py
+aiutils.cache 的测试
+"""
+import pandas as pd
+
+from aiutils.cache import hashable_lru
+
+
+def test_frozen_dataframe_hit_is_isolated():
+    """ frozen=True：修改命中的DataFrame(改值、增加列)不影响下一次命中 """
+
+    @hashable_lru(frozen=True)
+    def load(code):
+        return pd.DataFrame({'close': [1.0, 2.0], 'volume': [3, 4]})
+
+    hit = load('000001.XSHE')
+    try:
+        hit.iloc[0, 0] = 5.0  # 未开启copy-on-write时只读的block会报错
+    except ValueError:
+        pass
+    hit['new'] = 1
+
+    again = load('000001.XSHE')
+    assert again.iloc[0, 0] == 1.0
+    assert list(again.columns) == ['close', 'volume']
+    assert again is not hit
+
+
+def test_frozen_nested_dataframe_hit_is_isolated():
+    """ 容器中的DataFrame同样每次返回新的浅复制 """
+
+    @hashable_lru(frozen=True)
+    def load(code):
+        return {'df': pd.DataFrame({'close': [1.0, 2.0]}), 'codes': [code]}
+
+    hit = load('000001.XSHE')['df']
+    hit['close'] = 9.0
+    assert load('000001.XSHE')['df'].iloc[0, 0] == 1.0
+    assert load.cache_copy('000001.XSHE')['codes'] == ['000001.XSHE']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+@file: test_cache_segment.py
+aiutils.cache_segment 的测试
+"""
+import datetime
+
+import pandas as pd
+
+from aiutils.cache_segment import SegmentCache
+
+_BARS = pd.DataFrame({'close': range(24 * 60)}, index=pd.date_range('2024-01-01', periods=24 * 60, freq='h'))
+
+
+def _bars(code, start, end):
+    """ 按闭区间 [start, end] 返回小时数据 """
+    return _BARS[(_BARS.index >= pd.Timestamp(start)) & (_BARS.index <= pd.Timestamp(end))]
+
+
+def test_intraday_datetime_bounds():
+    """ datetime/pd.Timestamp的开始、结束：分段包含结束当天的全部时间，结果按传入的时间截取 """
+    calls = []
+
+    @SegmentCache.cached_function_result_for_a_time(freq='W')
+    def load(code, start, end):
+        calls.append((start, end))
+        return _bars(code, start, end)
+
+    start, end = datetime.datetime(2024, 1, 3, 10, 0), datetime.datetime(2024, 1, 17, 15, 0)
+    result = load('000001.XSHE', start, end)
+    expected = _bars('000001.XSHE', start, end)
+    pd.testing.assert_frame_equal(result, expected)
+    assert all(isinstance(x, datetime.datetime) for call in calls for x in call)
+    assert calls[0][1] == datetime.datetime.combine(calls[0][1].date(), datetime.time.max)
+
+    # 命中缓存的分段，按新的时间截取
+    n = len(calls)
+    start, end = datetime.datetime(2024, 1, 8, 9, 30), datetime.datetime(2024, 1, 14, 23, 0)
+    pd.testing.assert_frame_equal(load('000001.XSHE', start, end), _bars('000001.XSHE', start, end))
+    assert len(calls) == n
+
+
+def test_date_string_bounds_include_whole_end_day():
+    """ 日期字符串：结束当天的全部小时数据都包含在结果中 """
+
+    @SegmentCache.cached_function_result_for_a_time(freq='W')
+    def load(code, start, end):
+        return _bars(code, pd.Timestamp(start), pd.Timestamp(end) + pd.Timedelta(hours=23))
+
+    result = load('000001.XSHE', '2024-01-03', '2024-01-17')
+    assert len(result) == 15 * 24
+    assert result.index[-1] == pd.Timestamp('2024-01-17 23:00')